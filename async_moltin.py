@@ -0,0 +1,564 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import moltin
+from circuit_breaker import get_circuit_breaker
+from moltin import CART_INCLUDE_RECHECK_INTERVAL, CART_SNAPSHOT_TTL, CART_SNAPSHOTS_MAXSIZE, PAGE_SIZE, \
+    get_endpoint_name, get_next_page_request, get_related_item_ids, get_token_manager, is_server_error, parse_cart, \
+    refresh_rejected_token
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'))
+
+
+class AsyncMoltinClient:
+
+    def __init__(self, pool_size=16, max_concurrency=8, timeout=10, retries=3, backoff_factor=0.3):
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._cart_include_disabled_until = 0
+        self._cart_snapshots = OrderedDict()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, url, **kwargs):
+        response = await get_circuit_breaker(get_endpoint_name(url)).call_async(
+            self._send, method, url, is_failure=is_server_error, **kwargs
+        )
+        response.raise_for_status()
+        if response.status_code == 204:
+            return None
+
+        return response.json()
+
+    async def _send(self, method, url, **kwargs):
+        response = await self._send_with_retries(method, url, **kwargs)
+
+        headers = kwargs.get('headers') or {}
+        authorization = headers.get('Authorization', '')
+        if response.status_code == 401 and authorization.startswith('Bearer '):
+            loop = asyncio.get_running_loop()
+            fresh_token = await loop.run_in_executor(None, refresh_rejected_token, authorization[len('Bearer '):])
+            if fresh_token:
+                kwargs['headers'] = {**headers, 'Authorization': f'Bearer {fresh_token}'}
+                response = await self._send_with_retries(method, url, **kwargs)
+
+        return response
+
+    async def _send_with_retries(self, method, url, **kwargs):
+        is_idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.retries + 1):
+            is_last_attempt = attempt == self.retries or not is_idempotent
+            try:
+                response = await self._send_once(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if is_last_attempt:
+                    raise
+            else:
+                if is_last_attempt or not is_server_error(response):
+                    return response
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def _send_once(self, method, url, **kwargs):
+        await self.open()
+        async with self._semaphore:
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    return await build_response(response)
+            except asyncio.TimeoutError as error:
+                raise requests.Timeout(f'Timed out waiting for {url}') from error
+            except aiohttp.ClientConnectionError as error:
+                raise requests.ConnectionError(str(error)) from error
+
+    async def iter_pages(self, url, headers, params=None, page_size=PAGE_SIZE, prefetch=True):
+        params = dict(params or {}, **{'page[limit]': page_size, 'page[offset]': 0})
+        page = await self.request('GET', url, headers=headers, params=params)
+        next_page = None
+        try:
+            while True:
+                next_request = get_next_page_request(page, url, params, page_size)
+                if next_request is not None and prefetch:
+                    next_url, next_params = next_request
+                    next_page = asyncio.ensure_future(
+                        self.request('GET', next_url, headers=headers, params=next_params)
+                    )
+
+                yield page['data']
+
+                if next_request is None:
+                    return
+                if next_page is not None:
+                    page, next_page = await next_page, None
+                else:
+                    next_url, next_params = next_request
+                    page = await self.request('GET', next_url, headers=headers, params=next_params)
+                url, params = next_request
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_entries(self, moltin_access_token, flow, page_size=PAGE_SIZE):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        url = f'{moltin.API_URL}/v2/flows/{flow}/entries'
+        async for entries in self.iter_pages(url, headers, page_size=page_size):
+            for entry in entries:
+                yield entry
+
+    async def get_entries(self, moltin_access_token, flow):
+        return [entry async for entry in self.iter_entries(moltin_access_token, flow)]
+
+    async def get_customer_address(self, moltin_access_token, flow, id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        url = f'{moltin.API_URL}/v2/flows/{flow}/entries/{id}'
+        response = await self.request('GET', url, headers=headers)
+
+        return response['data']
+
+    async def create_customer_address(self, moltin_access_token, flow, longitude, latitude, telegram_chat_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'entry',
+                'customer_telegram_id': telegram_chat_id,
+                'lon': longitude,
+                'lat': latitude,
+            }
+        }
+        url = f'{moltin.API_URL}/v2/flows/{flow}/entries'
+        response = await self.request('POST', url, json=payload, headers=headers)
+
+        return response['data']['id']
+
+    async def create_shop_address(self, moltin_access_token, flow, address, alias, longitude, latitude):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'entry',
+                'Address': address,
+                'Alias': alias,
+                'Longitude': longitude,
+                'Latitude': latitude,
+            }
+        }
+        url = f'{moltin.API_URL}/v2/flows/{flow}/entries'
+        response = await self.request('POST', url, json=payload, headers=headers)
+
+        return response['data']
+
+    async def update_shop_address(self, moltin_access_token, flow, id, address, alias, longitude, latitude):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'entry',
+                'id': id,
+                'Address': address,
+                'Alias': alias,
+                'Longitude': longitude,
+                'Latitude': latitude,
+            }
+        }
+        url = f'{moltin.API_URL}/v2/flows/{flow}/entries/{id}'
+        response = await self.request('PUT', url, json=payload, headers=headers)
+
+        return response['data']
+
+    async def find_flow(self, moltin_access_token, slug):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        url = f'{moltin.API_URL}/v2/flows'
+        async for flows in self.iter_pages(url, headers):
+            for flow in flows:
+                if flow['slug'] == slug:
+                    return flow
+
+        return None
+
+    async def create_flow(self, moltin_access_token):
+        url = f'{moltin.API_URL}/v2/flows'
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'flow',
+                'name': 'Pizzeria',
+                'slug': 'Pizzeria',
+                'description': 'сеть ресторанов',
+                'enabled': True
+            }
+        }
+        response = await self.request('POST', url, json=payload, headers=headers)
+        flow_id = response['data']['id']
+
+        fields = ['Address', 'Alias', 'Longitude', 'Latitude']
+        await asyncio.gather(*[self.create_flow_field(moltin_access_token, flow_id, field) for field in fields])
+
+        return flow_id
+
+    async def create_flow_field(self, moltin_access_token, flow_id, field):
+        url = f'{moltin.API_URL}/v2/fields'
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'field',
+                'name': field,
+                'slug': field,
+                'field_type': 'string',
+                'description': '',
+                'required': False,
+                'enabled': True,
+                'relationships': {
+                    'flow': {
+                        'data': {
+                            'type': 'flow',
+                            'id': flow_id
+                        }
+                    }
+                }
+            }
+        }
+        await self.request('POST', url, json=payload, headers=headers)
+
+    async def create_product(self, moltin_access_token, img_link, sku, name, description):
+        product_id, img_id = await asyncio.gather(
+            self.create_pcm_product(moltin_access_token, sku, name, description),
+            self.upload_file(moltin_access_token, img_link),
+        )
+        await self.set_main_image(moltin_access_token, product_id, img_id)
+
+        return product_id
+
+    async def create_pcm_product(self, moltin_access_token, sku, name, description):
+        url = f'{moltin.API_URL}/pcm/products'
+        payload = {
+            'data': {
+                'type': 'product',
+                'attributes': {
+                    'commodity_type': 'physical',
+                    'sku': sku,
+                    'name': name,
+                    'status': 'live',
+                    'slug': sku,
+                    'description': description,
+                }
+            }
+        }
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        response = await self.request('POST', url, json=payload, headers=headers)
+
+        return response['data']['id']
+
+    async def upload_file(self, moltin_access_token, img_link):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}'
+        }
+        payload = aiohttp.FormData()
+        payload.add_field('file_location', img_link)
+        url = f'{moltin.API_URL}/v2/files'
+        response = await self.request('POST', url, data=payload, headers=headers)
+
+        return response['data']['id']
+
+    async def set_main_image(self, moltin_access_token, product_id, img_id):
+        url = f'{moltin.API_URL}/pcm/products/{product_id}/relationships/main_image'
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'data': {
+                'type': 'file',
+                'id': img_id
+            }
+        }
+        await self.request('POST', url, json=payload, headers=headers)
+
+    async def add_product_to_cart(self, moltin_access_token, product_id, amount, customer_id):
+        url = f'{moltin.API_URL}/v2/carts/{customer_id}/items'
+        payload = {
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': amount
+            }
+        }
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+            'Content-Type': 'application/json'
+        }
+        try:
+            await self.request('POST', url, json=payload, headers=headers)
+        finally:
+            self.invalidate_cart_snapshot(customer_id)
+
+    async def get_cart_items(self, moltin_access_token, customer_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        url = f'{moltin.API_URL}/v2/carts/{customer_id}'
+        if time.monotonic() >= self._cart_include_disabled_until:
+            try:
+                cart = await self.request('GET', url, headers=headers, params={'include': 'items'})
+            except requests.HTTPError as error:
+                if error.response.status_code != 400:
+                    raise
+            else:
+                cart_items = (cart.get('included') or {}).get('items')
+                if cart_items is None and not get_related_item_ids(cart):
+                    cart_items = []
+                elif cart_items is None:
+                    self._cart_include_disabled_until = time.monotonic() + CART_INCLUDE_RECHECK_INTERVAL
+                    cart_items = await self.fetch_cart_items(moltin_access_token, customer_id)
+
+                return cart_items, cart['data']['meta']['display_price']['with_tax']['amount']
+
+            self._cart_include_disabled_until = time.monotonic() + CART_INCLUDE_RECHECK_INTERVAL
+
+        cart_items, cart = await asyncio.gather(
+            self.fetch_cart_items(moltin_access_token, customer_id),
+            self.request('GET', url, headers=headers),
+        )
+
+        return cart_items, cart['data']['meta']['display_price']['with_tax']['amount']
+
+    async def fetch_cart_items(self, moltin_access_token, customer_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        url = f'{moltin.API_URL}/v2/carts/{customer_id}/items'
+        response = await self.request('GET', url, headers=headers)
+
+        return response['data']
+
+    async def get_cart_snapshot(self, moltin_access_token, customer_id):
+        customer_id = str(customer_id)
+        now = time.monotonic()
+        cached_snapshot = self._cart_snapshots.get(customer_id)
+        if cached_snapshot and cached_snapshot[0] > now:
+            self._cart_snapshots.move_to_end(customer_id)
+            return cached_snapshot[1]
+
+        cart = parse_cart(*await self.get_cart_items(moltin_access_token, customer_id))
+        self._cart_snapshots[customer_id] = (now + CART_SNAPSHOT_TTL, cart)
+        self._cart_snapshots.move_to_end(customer_id)
+        while len(self._cart_snapshots) > CART_SNAPSHOTS_MAXSIZE:
+            self._cart_snapshots.popitem(last=False)
+
+        return cart
+
+    def invalidate_cart_snapshot(self, customer_id):
+        self._cart_snapshots.pop(str(customer_id), None)
+
+    async def get_moltin_token(self, client_key, secret_key):
+        token_manager = get_token_manager(client_key, secret_key)
+
+        return await asyncio.get_running_loop().run_in_executor(None, token_manager.get_token)
+
+    async def iter_products(self, moltin_access_token, page_size=PAGE_SIZE):
+        url = f'{moltin.API_URL}/pcm/products'
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}'
+        }
+
+        async for products in self.iter_pages(url, headers, page_size=page_size):
+            for product in products:
+                yield product
+
+    async def get_products(self, moltin_access_token):
+        return [product async for product in self.iter_products(moltin_access_token)]
+
+    async def get_product(self, moltin_access_token, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        product_url = f'{moltin.API_URL}/pcm/products/{product_id}'
+        response = await self.request('GET', product_url, headers=headers)
+
+        return response['data']
+
+    async def get_stock(self, moltin_access_token, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        product_url = f'{moltin.API_URL}/v2/inventories/{product_id}'
+        response = await self.request('GET', product_url, headers=headers)
+
+        return response['data']['available']
+
+    async def iter_stocks(self, moltin_access_token, page_size=PAGE_SIZE):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        url = f'{moltin.API_URL}/v2/inventories'
+        async for inventories in self.iter_pages(url, headers, page_size=page_size):
+            for inventory in inventories:
+                yield inventory['id'], inventory['available']
+
+    async def get_stocks(self, moltin_access_token):
+        return {product_id: available async for product_id, available in self.iter_stocks(moltin_access_token)}
+
+    async def get_price(self, moltin_access_token, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        payload = {
+            'include': 'prices'
+        }
+        product_url = f'{moltin.API_URL}/catalog/products/{product_id}'
+        response = await self.request('GET', product_url, headers=headers, params=payload)
+
+        return response['data']['attributes']['price']
+
+    async def get_product_image(self, moltin_access_token, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        url = f'{moltin.API_URL}/pcm/products/{product_id}/relationships/main_image'
+        response = await self.request('GET', url, headers=headers)
+        image_id = response['data']['id']
+
+        url = f'{moltin.API_URL}/v2/files/{image_id}'
+        response = await self.request('GET', url, headers=headers)
+
+        return response['data']['link']['href']
+
+    async def get_product_card(self, moltin_access_token, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        payload = {
+            'include': 'prices,main_image'
+        }
+        url = f'{moltin.API_URL}/catalog/products/{product_id}'
+        catalog_product = await self.request('GET', url, headers=headers, params=payload)
+
+        product = catalog_product['data']
+        main_image = product.get('relationships', {}).get('main_image', {}).get('data') or {}
+        image_id, image_link = main_image.get('id'), None
+        for image in catalog_product.get('included', {}).get('main_images', []):
+            if image['id'] == image_id:
+                image_link = image['link']['href']
+                break
+
+        if image_id and not image_link:
+            url = f'{moltin.API_URL}/v2/files/{image_id}'
+            response = await self.request('GET', url, headers=headers)
+            image_link = response['data']['link']['href']
+
+        return {
+            'id': product_id,
+            'name': product['attributes']['name'],
+            'description': product['attributes'].get('description', ''),
+            'price': product['attributes']['price'],
+            'image_id': image_id,
+            'image_link': image_link,
+        }
+
+    async def delete_cart_item(self, moltin_access_token, chat_id, product_id):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}',
+        }
+        cart_url = f'{moltin.API_URL}/v2/carts/{chat_id}/items/{product_id}'
+        try:
+            await self.request('DELETE', cart_url, headers=headers)
+        finally:
+            self.invalidate_cart_snapshot(chat_id)
+
+    async def create_and_check_customer(self, moltin_access_token, name, email):
+        customer = await self.find_customer(moltin_access_token, email)
+        if customer is None:
+            customer = await self.create_customer(moltin_access_token, name, email)
+
+        return customer
+
+    async def iter_customers(self, moltin_access_token, email=None, page_size=PAGE_SIZE, prefetch=True):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}'
+        }
+        payload = {}
+        if email is not None:
+            payload['filter'] = f'eq(email,{email})'
+        url = f'{moltin.API_URL}/v2/customers'
+        async for customers in self.iter_pages(url, headers, params=payload, page_size=page_size, prefetch=prefetch):
+            for customer in customers:
+                yield customer
+
+    async def find_customer(self, moltin_access_token, email):
+        async for customer in self.iter_customers(moltin_access_token, email, page_size=1, prefetch=False):
+            return customer
+
+        return None
+
+    async def create_customer(self, moltin_access_token, name, email):
+        headers = {
+            'Authorization': f'Bearer {moltin_access_token}'
+        }
+        payload = {
+            'data': {
+                'type': 'customer',
+                'name': name,
+                'email': email,
+                'password': '',
+            },
+        }
+        url = f'{moltin.API_URL}/v2/customers'
+        response = await self.request('POST', url, headers=headers, json=payload)
+
+        return response['data']
+
+
+async def build_response(aiohttp_response):
+    response = requests.Response()
+    response.status_code = aiohttp_response.status
+    response.reason = aiohttp_response.reason
+    response.url = str(aiohttp_response.url)
+    response.headers = CaseInsensitiveDict(aiohttp_response.headers)
+    response._content = await aiohttp_response.read()
+
+    return response
@@ -0,0 +1,39 @@
+import timeit
+
+from cart import Cart, CartItem
+from rendering import build_menu_keyboard, get_menu_keyboard, render_cart, render_order
+
+PRODUCTS = [{'id': f'product-{number}', 'attributes': {'name': f'Пицца {number}'}} for number in range(30)]
+CART = Cart(
+    tuple(
+        CartItem(
+            id=f'item-{number}',
+            product_id=f'product-{number}',
+            name=f'Пицца {number}',
+            description='Томатный соус, моцарелла, пепперони',
+            unit_price=500,
+            quantity=2,
+            amount=1000,
+        )
+        for number in range(5)
+    ),
+    5000,
+)
+
+
+def main():
+    benchmarks = {
+        'build_menu_keyboard': lambda: build_menu_keyboard(PRODUCTS, True),
+        'get_menu_keyboard (cached)': lambda: get_menu_keyboard(PRODUCTS, 'catalog-version'),
+        'render_cart': lambda: render_cart(CART),
+        'render_order': lambda: render_order(CART, '100'),
+    }
+    for name, benchmark in benchmarks.items():
+        timer = timeit.Timer(benchmark)
+        loops, _ = timer.autorange()
+        best_time = min(timer.repeat(repeat=5, number=loops)) / loops
+        print(f'{name}: {best_time * 1e6:.1f} µs per call')
+
+
+if __name__ == '__main__':
+    main()
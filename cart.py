@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+
+import requests
+
+from moltin import Cart, CartItem, add_product_to_cart, delete_cart_item, get_cart_snapshot, invalidate_cart_snapshot
+
+logger = logging.getLogger('shop_tg_bot')
+
+
+class LocalCartStore:
+
+    def __init__(self, redis_db, get_token, namespace='shop_bot:cart', sync_interval=2, ttl=7 * 86400):
+        self.redis_db = redis_db
+        self.get_token = get_token
+        self.namespace = namespace
+        self.sync_interval = sync_interval
+        self.ttl = ttl
+        self.dirty_key = f'{namespace}:dirty'
+        self.stats = {'adds': 0, 'synced_updates': 0, 'failed_syncs': 0, 'rejected_updates': 0, 'reconciliations': 0}
+        self._stats_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, chat_id, product_card, quantity):
+        product_id = product_card['id']
+        product = {
+            'name': product_card['name'],
+            'description': product_card['description'],
+            'unit_price': product_card['price']['RUB']['amount'],
+        }
+        pipeline = self.redis_db.pipeline()
+        pipeline.hincrby(self._get_key(chat_id, 'pending'), product_id, quantity)
+        pipeline.hincrby(self._get_key(chat_id, 'quantities'), product_id, quantity)
+        pipeline.hsetnx(self._get_key(chat_id, 'products'), product_id, json.dumps(product))
+        pipeline.sadd(self.dirty_key, chat_id)
+        for key_kind in ('pending', 'quantities', 'products'):
+            pipeline.expire(self._get_key(chat_id, key_kind), self.ttl)
+        pipeline.execute()
+        self._count('adds')
+
+    def get_cart(self, chat_id):
+        pipeline = self.redis_db.pipeline()
+        pipeline.exists(self._get_key(chat_id, 'synced'))
+        pipeline.hgetall(self._get_key(chat_id, 'quantities'))
+        pipeline.hgetall(self._get_key(chat_id, 'products'))
+        is_synced, quantities, products = pipeline.execute()
+        if not is_synced:
+            return None
+
+        items = []
+        for product_id, quantity in quantities.items():
+            quantity = int(quantity)
+            if quantity <= 0 or product_id not in products:
+                continue
+            product = json.loads(products[product_id])
+            items.append(CartItem(
+                id=product_id.decode('utf-8'),
+                product_id=product_id.decode('utf-8'),
+                name=product['name'],
+                description=product['description'],
+                unit_price=product['unit_price'],
+                quantity=quantity,
+                amount=product['unit_price'] * quantity,
+            ))
+
+        return Cart(tuple(items), sum(item.amount for item in items))
+
+    def get_or_reconcile_cart(self, chat_id):
+        cart = self.get_cart(chat_id)
+        if cart is None:
+            cart = self.reconcile(chat_id)
+
+        return cart
+
+    def reconcile(self, chat_id):
+        self.sync(chat_id)
+        invalidate_cart_snapshot(chat_id)
+        cart = get_cart_snapshot(self.get_token(), chat_id)
+        self._load(chat_id, cart)
+        self._count('reconciliations')
+
+        return cart
+
+    def remove(self, chat_id, product_id):
+        self.sync(chat_id)
+        invalidate_cart_snapshot(chat_id)
+        for cart_item in get_cart_snapshot(self.get_token(), chat_id).items:
+            if product_id in (cart_item.product_id, cart_item.id):
+                delete_cart_item(self.get_token(), chat_id, cart_item.id)
+
+        return self.reconcile(chat_id)
+
+    def sync(self, chat_id):
+        pending_key = self._get_key(chat_id, 'pending')
+        pipeline = self.redis_db.pipeline(transaction=True)
+        pipeline.hgetall(pending_key)
+        pipeline.delete(pending_key)
+        pending_updates, _ = pipeline.execute()
+        pending_updates = [
+            (product_id.decode('utf-8'), int(quantity))
+            for product_id, quantity in pending_updates.items() if int(quantity) > 0
+        ]
+
+        for update_index, (product_id, quantity) in enumerate(pending_updates):
+            try:
+                add_product_to_cart(self.get_token(), product_id, quantity, chat_id)
+            except requests.HTTPError as error:
+                if is_retryable(error):
+                    self._requeue(chat_id, pending_updates[update_index:])
+                    self._count('failed_syncs')
+                    raise
+                logger.warning(f'Moltin отклонил добавление товара {product_id} в корзину {chat_id}: {error}')
+                self.redis_db.delete(self._get_key(chat_id, 'synced'))
+                self._count('rejected_updates')
+                continue
+            except Exception:
+                self._requeue(chat_id, pending_updates[update_index:])
+                self._count('failed_syncs')
+                raise
+            self._count('synced_updates')
+
+    def sync_dirty(self, batch_size=100):
+        chat_ids = self.redis_db.spop(self.dirty_key, batch_size)
+        for chat_id in chat_ids:
+            try:
+                self.sync(chat_id.decode('utf-8'))
+            except Exception:
+                logger.warning(f'Не удалось синхронизировать корзину {chat_id}', exc_info=True)
+
+        return len(chat_ids)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.sync_dirty()
+            except Exception:
+                logger.exception('Не удалось синхронизировать корзины')
+            self._stopped.wait(self.sync_interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def _load(self, chat_id, cart):
+        quantities_key = self._get_key(chat_id, 'quantities')
+        products_key = self._get_key(chat_id, 'products')
+        pending_updates = self.redis_db.hgetall(self._get_key(chat_id, 'pending'))
+
+        pipeline = self.redis_db.pipeline(transaction=True)
+        pipeline.delete(quantities_key, products_key)
+        for item in cart.items:
+            product_id = item.product_id or item.id
+            pipeline.hincrby(quantities_key, product_id, item.quantity)
+            product = {'name': item.name, 'description': item.description, 'unit_price': item.unit_price}
+            pipeline.hset(products_key, product_id, json.dumps(product))
+        for product_id, quantity in pending_updates.items():
+            pipeline.hincrby(quantities_key, product_id, int(quantity))
+        pipeline.set(self._get_key(chat_id, 'synced'), 1, ex=self.ttl)
+        pipeline.expire(quantities_key, self.ttl)
+        pipeline.expire(products_key, self.ttl)
+        pipeline.execute()
+
+    def _requeue(self, chat_id, pending_updates):
+        pending_key = self._get_key(chat_id, 'pending')
+        pipeline = self.redis_db.pipeline()
+        for product_id, quantity in pending_updates:
+            pipeline.hincrby(pending_key, product_id, quantity)
+        pipeline.expire(pending_key, self.ttl)
+        pipeline.sadd(self.dirty_key, chat_id)
+        pipeline.execute()
+
+    def _get_key(self, chat_id, key_kind):
+        return f'{self.namespace}:{chat_id}:{key_kind}'
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self.stats[counter] += 1
+
+
+def is_retryable(error):
+    if error.response is None:
+        return True
+    status_code = error.response.status_code
+
+    return status_code >= 500 or status_code == 429
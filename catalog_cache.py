@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('shop_tg_bot')
+
+
+class ProductCatalogCache:
+
+    def __init__(
+            self,
+            fetch_products,
+            ttl=300,
+            stale_ttl=86400,
+            retry_interval=30,
+            redis_db=None,
+            namespace='shop_bot:catalog',
+    ):
+        self.fetch_products = fetch_products
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.retry_interval = retry_interval
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.version = None
+        self._products = None
+        self._fetched_at = 0
+        self._retry_at = 0
+        self._is_failing = False
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_products(self):
+        return self.get_catalog()[0]
+
+    def get_catalog(self):
+        if self._products is None:
+            if not self._load_shared(fresh_only=False):
+                self.refresh()
+        elif time.time() - self._fetched_at > self.ttl and time.time() >= self._retry_at:
+            self._refresh_in_background()
+
+        with self._lock:
+            return self._products, self.version
+
+    def refresh(self):
+        if self._load_shared(fresh_only=True):
+            return
+
+        try:
+            products = self.fetch_products()
+        except Exception:
+            with self._lock:
+                self._retry_at = time.time() + self.retry_interval
+                is_new_failure = not self._is_failing
+                self._is_failing = True
+            if self._products is None and not self._load_shared(fresh_only=False):
+                raise
+            if is_new_failure:
+                logger.warning('Не удалось обновить каталог, показываем сохраненную версию', exc_info=True)
+            return
+
+        with self._lock:
+            was_failing, self._is_failing = self._is_failing, False
+        if was_failing:
+            logger.info('Каталог снова обновляется')
+
+        serialized_products = json.dumps(products, sort_keys=True, ensure_ascii=False)
+        version = hashlib.sha1(serialized_products.encode('utf-8')).hexdigest()
+        fetched_at = time.time()
+        self._set_products(products, version, fetched_at)
+
+        if self.redis_db is not None:
+            payload = json.dumps({'fetched_at': fetched_at, 'products': products}, ensure_ascii=False)
+            pipeline = self.redis_db.pipeline()
+            pipeline.set(f'{self.namespace}:products:{version}', payload, ex=self.stale_ttl)
+            pipeline.set(f'{self.namespace}:version', version, ex=self.stale_ttl)
+            pipeline.execute()
+
+    def invalidate(self):
+        with self._lock:
+            self._products = None
+            self.version = None
+            self._fetched_at = 0
+
+        if self.redis_db is not None:
+            self.redis_db.delete(f'{self.namespace}:version')
+
+    def _set_products(self, products, version, fetched_at):
+        with self._lock:
+            self._products = products
+            self.version = version
+            self._fetched_at = fetched_at
+
+    def _load_shared(self, fresh_only):
+        if self.redis_db is None:
+            return False
+
+        version = self.redis_db.get(f'{self.namespace}:version')
+        if not version:
+            return False
+        version = version.decode('utf-8')
+
+        payload = self.redis_db.get(f'{self.namespace}:products:{version}')
+        if not payload:
+            return False
+        catalog = json.loads(payload)
+        if fresh_only and time.time() - catalog['fetched_at'] > self.ttl:
+            return False
+
+        self._set_products(catalog['products'], version, catalog['fetched_at'])
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.warning('Фоновое обновление каталога завершилось ошибкой', exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('shop_tg_bot')
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+_circuit_breaker_options = {}
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'Сервис {name} временно недоступен, повторите через {retry_after:.0f} с')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+
+    def __init__(
+            self,
+            name,
+            window=30,
+            min_calls=10,
+            failure_rate=0.5,
+            slow_call_seconds=5,
+            open_seconds=30,
+            half_open_calls=1,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = 'closed'
+        self.stats = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self._calls = deque()
+        self._opened_at = 0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, is_failure=None, **kwargs):
+        is_probe = self._acquire()
+        started_at = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record(False, time.monotonic() - started_at, is_probe)
+            raise
+
+        self._record(not (is_failure and is_failure(result)), time.monotonic() - started_at, is_probe)
+
+        return result
+
+    async def call_async(self, func, *args, is_failure=None, **kwargs):
+        is_probe = self._acquire()
+        started_at = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self._record(False, time.monotonic() - started_at, is_probe)
+            raise
+
+        self._record(not (is_failure and is_failure(result)), time.monotonic() - started_at, is_probe)
+
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['state'] = self.state
+
+        return stats
+
+    def _acquire(self):
+        with self._lock:
+            if self.state == 'open':
+                retry_after = self._opened_at + self.open_seconds - time.monotonic()
+                if retry_after > 0:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.name, retry_after)
+                self.state = 'half_open'
+                self._probes = 0
+
+            if self.state == 'half_open':
+                if self._probes >= self.half_open_calls:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.name, 0)
+                self._probes += 1
+                return True
+
+        return False
+
+    def _record(self, is_success, elapsed, is_probe):
+        is_slow = elapsed > self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['failures'] += not is_success
+            self.stats['slow_calls'] += is_slow
+
+            if is_probe:
+                self._probes -= 1
+                if is_success and not is_slow:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+
+            self._calls.append((now, is_success and not is_slow))
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._calls.popleft()
+
+            if self.state != 'closed' or len(self._calls) < self.min_calls:
+                return
+            failed_calls = sum(1 for _, is_good in self._calls if not is_good)
+            if failed_calls / len(self._calls) >= self.failure_rate:
+                self._open(now)
+
+    def _open(self, now):
+        if self.state == 'closed':
+            logger.warning(f'Сервис {self.name} отвечает с ошибками, запросы к нему приостановлены')
+            self.stats['opened'] += 1
+        self.state = 'open'
+        self._opened_at = now
+        self._calls.clear()
+
+    def _close(self):
+        logger.info(f'Сервис {self.name} снова доступен')
+        self.state = 'closed'
+        self._calls.clear()
+
+
+def configure_circuit_breakers(**circuit_breaker_options):
+    with _circuit_breakers_lock:
+        _circuit_breaker_options.update(circuit_breaker_options)
+        _circuit_breakers.clear()
+
+
+def get_circuit_breaker(name):
+    with _circuit_breakers_lock:
+        circuit_breaker = _circuit_breakers.get(name)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(name, **_circuit_breaker_options)
+            _circuit_breakers[name] = circuit_breaker
+
+    return circuit_breaker
+
+
+def get_circuit_breakers_stats():
+    with _circuit_breakers_lock:
+        circuit_breakers = list(_circuit_breakers.values())
+
+    return {circuit_breaker.name: circuit_breaker.get_stats() for circuit_breaker in circuit_breakers}
@@ -1,17 +1,471 @@
+import json
+import logging
+import math
+import re
+import shelve
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+import numpy as np
 import requests
 from geopy import distance
 
+from circuit_breaker import get_circuit_breaker
 from moltin import get_entries
 
+logger = logging.getLogger('shop_tg_bot')
+
+EARTH_RADIUS_KM = 6371.0088
+GEOCODER_TIMEOUT = (3.05, 5)
+
+DELIVERY_TIERS = (
+    (0.5, 0),
+    (5, 100),
+    (20, 300),
+)
+
+BatchZoning = namedtuple('BatchZoning', ['pizzeria_indexes', 'distances', 'shipping_costs'])
+
+_pizzeria_index = None
+_pizzeria_index_lock = threading.Lock()
+_geocode_cache = None
+_geocode_cache_lock = threading.Lock()
+_geocoder_rate_limiter = None
+
+
+class GeocodeCache:
+
+    def __init__(
+            self,
+            ttl=30 * 86400,
+            negative_ttl=86400,
+            max_entries=10000,
+            redis_db=None,
+            path=None,
+            namespace='shop_bot:geocode',
+            lru_batch_size=100,
+            lru_flush_interval=10,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.lru_batch_size = lru_batch_size
+        self.lru_flush_interval = lru_flush_interval
+        self.shelf = shelve.open(path) if path and redis_db is None else None
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0, 'persistent_evictions': 0}
+        self._entries = OrderedDict()
+        self._touched_keys = {}
+        self._touches_flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._shelf_lock = threading.Lock()
+
+    def get(self, address):
+        key = normalize_address(address)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None:
+            entry = self._load_entry(key)
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+
+        with self._lock:
+            if entry is not None and entry['expires_at'] <= now:
+                self._entries.pop(key, None)
+                entry = None
+
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            if entry['coordinates'] is None:
+                self.stats['negative_hits'] += 1
+            else:
+                self.stats['hits'] += 1
+            touched_keys = self._touch(key, now)
+
+        if touched_keys:
+            self._flush_touches(touched_keys)
+
+        if entry['coordinates'] is None:
+            return True, None
+
+        return True, tuple(entry['coordinates'])
+
+    def set(self, address, coordinates):
+        key = normalize_address(address)
+        ttl = self.ttl if coordinates else self.negative_ttl
+        entry = {
+            'coordinates': list(coordinates) if coordinates else None,
+            'expires_at': time.time() + ttl,
+        }
+        with self._lock:
+            self._remember(key, entry)
+        self._store_entry(key, entry, ttl)
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+            hit_ratio = (self.stats['hits'] + self.stats['negative_hits']) / lookups if lookups else 0
+
+            return {**self.stats, 'entries': len(self._entries), 'hit_ratio': hit_ratio}
+
+    def close(self):
+        with self._lock:
+            touched_keys, self._touched_keys = self._touched_keys, {}
+        if touched_keys:
+            self._flush_touches(touched_keys)
+        if self.shelf is not None:
+            with self._shelf_lock:
+                self.shelf.close()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _touch(self, key, now):
+        if self.redis_db is None and self.shelf is None:
+            return None
+
+        self._touched_keys[key] = now
+        is_flush_due = time.monotonic() - self._touches_flushed_at > self.lru_flush_interval
+        if len(self._touched_keys) < self.lru_batch_size and not is_flush_due:
+            return None
+
+        touched_keys, self._touched_keys = self._touched_keys, {}
+        self._touches_flushed_at = time.monotonic()
+
+        return touched_keys
+
+    def _flush_touches(self, touched_keys):
+        if self.redis_db is not None:
+            self.redis_db.zadd(f'{self.namespace}:lru', touched_keys)
+            return
+
+        with self._shelf_lock:
+            for key, accessed_at in touched_keys.items():
+                entry = self.shelf.get(key)
+                if entry is not None:
+                    self.shelf[key] = {**entry, 'accessed_at': accessed_at}
+
+    def _load_entry(self, key):
+        if self.redis_db is not None:
+            entry = self.redis_db.get(f'{self.namespace}:{key}')
+            return json.loads(entry) if entry else None
+        if self.shelf is not None:
+            with self._shelf_lock:
+                return self.shelf.get(key)
+
+        return None
+
+    def _store_entry(self, key, entry, ttl):
+        if self.redis_db is not None:
+            pipeline = self.redis_db.pipeline()
+            pipeline.set(f'{self.namespace}:{key}', json.dumps(entry), ex=int(ttl))
+            pipeline.zadd(f'{self.namespace}:lru', {key: time.time()})
+            pipeline.zcard(f'{self.namespace}:lru')
+            *_, stored_count = pipeline.execute()
+            if stored_count > self.max_entries:
+                self._evict_shared(stored_count - self.max_entries)
+        elif self.shelf is not None:
+            with self._shelf_lock:
+                self.shelf[key] = {**entry, 'accessed_at': time.time()}
+                if len(self.shelf) > self.max_entries * 1.1:
+                    self._evict_shelf()
+
+    def _evict_shared(self, count):
+        lru_key = f'{self.namespace}:lru'
+        evicted_keys = self.redis_db.zrange(lru_key, 0, count - 1)
+        if not evicted_keys:
+            return
+        pipeline = self.redis_db.pipeline()
+        pipeline.delete(*[f'{self.namespace}:{key.decode("utf-8")}' for key in evicted_keys])
+        pipeline.zrem(lru_key, *evicted_keys)
+        pipeline.execute()
+        with self._lock:
+            self.stats['persistent_evictions'] += len(evicted_keys)
+
+    def _evict_shelf(self):
+        now = time.time()
+        with self._lock:
+            touched_keys = dict(self._touched_keys)
+        entries = sorted(
+            (entry['expires_at'] > now, touched_keys.get(key, entry.get('accessed_at', 0)), key)
+            for key, entry in self.shelf.items()
+        )
+        evicted_count = len(entries) - self.max_entries
+        for is_alive, _, key in entries:
+            if evicted_count <= 0 and is_alive:
+                break
+            del self.shelf[key]
+            evicted_count -= 1
+            with self._lock:
+                self.stats['persistent_evictions'] += 1
+        self.shelf.sync()
+
+
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PizzeriaIndex:
+
+    def __init__(self, fetch_pizzerias, ttl=600, cell_size=0.1):
+        self.fetch_pizzerias = fetch_pizzerias
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.pizzerias = []
+        self._cells = {}
+        self._fingerprint = None
+        self._refreshed_at = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self, moltin_token):
+        try:
+            pizzerias = self.fetch_pizzerias(moltin_token)
+        except Exception:
+            if self._fingerprint is None:
+                raise
+            logger.warning('Не удалось обновить список пиццерий, используем сохраненный', exc_info=True)
+            return
+
+        fingerprint = tuple(sorted(
+            (pizzeria['id'], pizzeria['Latitude'], pizzeria['Longitude']) for pizzeria in pizzerias
+        ))
+
+        with self._lock:
+            self._refreshed_at = time.monotonic()
+            if fingerprint == self._fingerprint:
+                return
+
+            cells = {}
+            for pizzeria in pizzerias:
+                lat, lon = float(pizzeria['Latitude']), float(pizzeria['Longitude'])
+                cells.setdefault(self._get_cell(lat, lon), []).append((lat, lon, pizzeria))
+            self.pizzerias, self._cells, self._fingerprint = pizzerias, cells, fingerprint
+
+    def invalidate(self):
+        with self._lock:
+            self._refreshed_at = 0
+
+    def get_nearest(self, lon, lat, moltin_token, count=1):
+        if self._fingerprint is None:
+            with self._refresh_lock:
+                if self._fingerprint is None:
+                    self.refresh(moltin_token)
+        elif time.monotonic() - self._refreshed_at > self.ttl:
+            self._refresh_in_background(moltin_token)
+
+        lat, lon = float(lat), float(lon)
+        with self._lock:
+            cells = self._cells
+        candidates = self._get_candidates(cells, lat, lon, count)
+
+        nearest_pizzerias = []
+        for pizzeria in candidates:
+            pizzeria_coordinate = (pizzeria['Latitude'], pizzeria['Longitude'])
+            nearest_pizzeria = dict(pizzeria)
+            nearest_pizzeria['distance'] = distance.distance(pizzeria_coordinate, (lat, lon)).km
+            nearest_pizzerias.append(nearest_pizzeria)
+        nearest_pizzerias.sort(key=get_distance)
+
+        return nearest_pizzerias[:count]
+
+    def _refresh_in_background(self, moltin_token):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._background_refresh, args=(moltin_token,), daemon=True).start()
+
+    def _background_refresh(self, moltin_token):
+        try:
+            with self._refresh_lock:
+                self.refresh(moltin_token)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _get_cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def _get_candidates(self, cells, lat, lon, count):
+        center_row, center_column = self._get_cell(lat, lon)
+        rings = {}
+        for (row, column), cell_pizzerias in cells.items():
+            ring = max(abs(row - center_row), abs(column - center_column))
+            rings.setdefault(ring, []).extend(cell_pizzerias)
+
+        cell_height_km = math.radians(self.cell_size) * EARTH_RADIUS_KM
+        scored = []
+        for ring in sorted(rings):
+            if len(scored) >= count:
+                scored.sort(key=lambda candidate: candidate[0])
+                farthest_lat = min(abs(lat) + ring * self.cell_size, 89.9)
+                cell_width_km = cell_height_km * max(math.cos(math.radians(farthest_lat)), 0.01)
+                unexplored_distance_km = (ring - 1) * min(cell_height_km, cell_width_km)
+                if scored[count - 1][0] <= unexplored_distance_km:
+                    break
+            for pizzeria_lat, pizzeria_lon, pizzeria in rings[ring]:
+                scored.append((get_haversine_distance(lat, lon, pizzeria_lat, pizzeria_lon), pizzeria))
+
+        if not scored:
+            return []
+        scored.sort(key=lambda candidate: candidate[0])
+        # haversine differs from the geodesic distance by less than 0.5%,
+        # so everything within that margin of the k-th candidate is checked exactly
+        threshold = scored[min(count, len(scored)) - 1][0] * 1.01 + 0.01
+
+        return [pizzeria for haversine_km, pizzeria in scored if haversine_km <= threshold]
+
+
+def get_haversine_distance(lat, lon, other_lat, other_lon):
+    lat, lon, other_lat, other_lon = map(math.radians, (lat, lon, other_lat, other_lon))
+    chord = (
+        math.sin((other_lat - lat) / 2) ** 2
+        + math.cos(lat) * math.cos(other_lat) * math.sin((other_lon - lon) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(chord))
+
+
+def get_delivery_cost(distance):
+    whole_km = int(distance)
+    for max_distance, shipping_cost in DELIVERY_TIERS:
+        if whole_km <= max_distance:
+            return shipping_cost
+
+    return None
+
+
+def get_delivery_costs(distances):
+    whole_km = np.floor(distances)
+    shipping_costs = np.full(whole_km.shape, np.nan)
+    for max_distance, shipping_cost in reversed(DELIVERY_TIERS):
+        shipping_costs[whole_km <= max_distance] = shipping_cost
+
+    return shipping_costs
+
+
+def get_haversine_distances(lats, lons, other_lats, other_lons):
+    lats, lons = np.radians(lats)[:, np.newaxis], np.radians(lons)[:, np.newaxis]
+    other_lats, other_lons = np.radians(other_lats)[np.newaxis, :], np.radians(other_lons)[np.newaxis, :]
+    chord = (
+        np.sin((other_lats - lats) / 2) ** 2
+        + np.cos(lats) * np.cos(other_lats) * np.sin((other_lons - lons) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(chord))
+
+
+def zone_coordinates(coordinates, pizzerias, chunk_size=20000):
+    points = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    pizzeria_lats = np.array([float(pizzeria['Latitude']) for pizzeria in pizzerias])
+    pizzeria_lons = np.array([float(pizzeria['Longitude']) for pizzeria in pizzerias])
+
+    pizzeria_indexes = np.empty(len(points), dtype=int)
+    distances = np.empty(len(points))
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        chunk_distances = get_haversine_distances(chunk[:, 1], chunk[:, 0], pizzeria_lats, pizzeria_lons)
+        nearest = chunk_distances.argmin(axis=1)
+        pizzeria_indexes[start:start + len(chunk)] = nearest
+        distances[start:start + len(chunk)] = chunk_distances[np.arange(len(chunk)), nearest]
+
+    return BatchZoning(pizzeria_indexes, distances, get_delivery_costs(distances))
+
+
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+
+    return ' '.join(re.findall(r'\w+', address))
+
+
+def configure_geocode_cache(**geocode_cache_options):
+    global _geocode_cache
+
+    with _geocode_cache_lock:
+        if _geocode_cache is not None:
+            _geocode_cache.close()
+        _geocode_cache = GeocodeCache(**geocode_cache_options)
+
+    return _geocode_cache
+
+
+def get_geocode_cache():
+    global _geocode_cache
+
+    with _geocode_cache_lock:
+        if _geocode_cache is None:
+            _geocode_cache = GeocodeCache()
+
+    return _geocode_cache
+
+
+def configure_geocoder_rate_limit(requests_per_second):
+    global _geocoder_rate_limiter
+
+    _geocoder_rate_limiter = RateLimiter(requests_per_second) if requests_per_second else None
+
+
+def get_pizzeria_index():
+    global _pizzeria_index
+
+    with _pizzeria_index_lock:
+        if _pizzeria_index is None:
+            _pizzeria_index = PizzeriaIndex(partial(get_entries, flow='Pizzeria'))
+
+    return _pizzeria_index
+
 
 def fetch_coordinates(apikey, address):
+    geocode_cache = get_geocode_cache()
+    is_cached, coordinates = geocode_cache.get(address)
+    if is_cached:
+        return coordinates
+
+    if _geocoder_rate_limiter is not None:
+        _geocoder_rate_limiter.wait()
+    coordinates = get_circuit_breaker('geocode-maps.yandex.ru').call(request_coordinates, apikey, address)
+    geocode_cache.set(address, coordinates)
+
+    return coordinates
+
+
+def request_coordinates(apikey, address):
     payload = {
         'geocode': address,
         'apikey': apikey,
         'format': 'json',
     }
     url = 'https://geocode-maps.yandex.ru/1.x'
-    response = requests.get(url, params=payload)
+    response = requests.get(url, params=payload, timeout=GEOCODER_TIMEOUT)
     response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
@@ -24,14 +478,11 @@ def fetch_coordinates(apikey, address):
 
 
 def get_nearest_pizzeria(lon, lat, moltin_token):
-    pizzerias = get_entries(moltin_token, 'Pizzeria')
-    for pizzeria in pizzerias:
-        pizzeria_coordinate = (pizzeria['Latitude'], pizzeria['Longitude'])
-        pizzeria_distance = distance.distance(pizzeria_coordinate, (lat, lon)).km
-        pizzeria['distance'] = pizzeria_distance
-
-    nearest_pizzeria = min(pizzerias, key=get_distance)
-    return nearest_pizzeria
+    return get_pizzeria_index().get_nearest(lon, lat, moltin_token)[0]
+
+
+def get_nearest_pizzerias(lon, lat, moltin_token, count):
+    return get_pizzeria_index().get_nearest(lon, lat, moltin_token, count)
 
 
 def get_distance(pizzerias):
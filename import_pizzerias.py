@@ -0,0 +1,141 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import moltin
+from geolocation_tools import configure_geocode_cache, configure_geocoder_rate_limit, fetch_coordinates, \
+    get_pizzeria_index
+from moltin import configure_client, create_flow, create_shop_address, find_flow, get_moltin_token, iter_entries, \
+    update_shop_address
+
+logger = logging.getLogger('import_pizzerias')
+
+PIZZERIA_FLOW = 'Pizzeria'
+
+
+class PizzeriaImporter:
+
+    def __init__(self, get_token, yandex_api_token, flow=PIZZERIA_FLOW, workers=8):
+        self.get_token = get_token
+        self.yandex_api_token = yandex_api_token
+        self.flow = flow
+        self.workers = workers
+        self.stats = {'created': 0, 'updated': 0, 'unchanged': 0, 'not_found': 0, 'failed': 0, 'geocoded': 0}
+        self._lock = threading.Lock()
+        self._existing_entries = {}
+
+    def run(self, pizzerias):
+        started_at = time.monotonic()
+        if find_flow(self.get_token(), self.flow) is None:
+            create_flow(self.get_token())
+        self._existing_entries = {entry['Alias']: entry for entry in iter_entries(self.get_token(), self.flow)}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(self._import_pizzeria, pizzerias))
+
+        elapsed = time.monotonic() - started_at
+        logger.info(f'Пиццерии загружены за {elapsed:.1f} с: {self.stats}')
+
+        return self.stats
+
+    def _import_pizzeria(self, pizzeria):
+        address, alias, longitude, latitude = pizzeria
+        try:
+            if longitude is None or latitude is None:
+                coordinates = fetch_coordinates(self.yandex_api_token, address)
+                self._count('geocoded')
+                if coordinates is None:
+                    logger.warning(f'Не удалось найти координаты пиццерии {alias}: {address}')
+                    self._count('not_found')
+                    return
+                longitude, latitude = coordinates
+            longitude, latitude = str(longitude), str(latitude)
+
+            entry = self._existing_entries.get(alias)
+            if entry is None:
+                create_shop_address(self.get_token(), self.flow, address, alias, longitude, latitude)
+                self._count('created')
+            elif (entry['Address'], entry['Longitude'], entry['Latitude']) != (address, longitude, latitude):
+                update_shop_address(self.get_token(), self.flow, entry['id'], address, alias, longitude, latitude)
+                self._count('updated')
+            else:
+                self._count('unchanged')
+        except Exception:
+            logger.exception(f'Не удалось загрузить пиццерию {alias}')
+            self._count('failed')
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+def read_pizzerias(pizzerias_path):
+    with open(pizzerias_path, encoding='utf-8') as pizzerias_file:
+        if pizzerias_path.endswith('.csv'):
+            records = list(csv.DictReader(pizzerias_file))
+        else:
+            records = json.load(pizzerias_file)
+
+    pizzerias = {}
+    for record in records:
+        address, alias, longitude, latitude = parse_pizzeria(record)
+        pizzerias[alias] = address, alias, longitude, latitude
+
+    return list(pizzerias.values())
+
+
+def parse_pizzeria(record):
+    if isinstance(record.get('address'), dict):
+        coordinates = record.get('coordinates') or {}
+        return record['address']['full'], record['alias'], coordinates.get('lon'), coordinates.get('lat')
+
+    return (
+        record['address'],
+        record['alias'],
+        record.get('longitude') or None,
+        record.get('latitude') or None,
+    )
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Загружает адреса пиццерий в Moltin')
+    parser.add_argument('pizzerias_path', help='JSON или CSV файл с адресами пиццерий')
+    parser.add_argument('--workers', type=int, default=8, help='сколько пиццерий загружается одновременно')
+    parser.add_argument('--geocode-rate', type=float, default=5, help='сколько запросов в секунду отправлять геокодеру')
+    parser.add_argument('--geocode-cache', default='geocode_cache', help='файл кеша геокодера')
+    parser.add_argument('--api-url', default=moltin.API_URL, help='адрес API Moltin')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    moltin.API_URL = args.api_url.rstrip('/')
+    configure_client(pool_maxsize=max(args.workers, 16))
+    geocode_cache = configure_geocode_cache(path=args.geocode_cache)
+    configure_geocoder_rate_limit(args.geocode_rate)
+
+    client_id = os.getenv('MOLTIN_CLIENT_KEY')
+    client_secret = os.getenv('SECRET_KEY')
+    importer = PizzeriaImporter(
+        lambda: get_moltin_token(client_id, client_secret),
+        os.getenv('YANDEX_API'),
+        workers=args.workers,
+    )
+    try:
+        importer.run(read_pizzerias(args.pizzerias_path))
+    finally:
+        geocode_cache.close()
+
+    pizzeria_index = get_pizzeria_index()
+    pizzeria_index.refresh(get_moltin_token(client_id, client_secret))
+    logger.info(f'Индекс пиццерий перестроен, пиццерий: {len(pizzeria_index.pizzerias)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import moltin
+from moltin import configure_client, create_pcm_product, get_moltin_token, iter_products, set_main_image, upload_file
+
+logger = logging.getLogger('import_products')
+
+PRODUCT_COUNTERS = ('created', 'images_linked', 'skipped', 'failed')
+
+
+class ProductImporter:
+
+    def __init__(self, get_token, checkpoint_path, workers=8, report_every=50):
+        self.get_token = get_token
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.report_every = report_every
+        self.stats = {'created': 0, 'images_linked': 0, 'skipped': 0, 'failed': 0, 'uploaded': 0, 'reused': 0}
+        self._lock = threading.Lock()
+        self._images = {}
+        self._existing_products = {}
+        self._done_skus = set()
+        self._started_at = None
+
+    def run(self, menu_items):
+        self._started_at = time.monotonic()
+        self._done_skus = load_checkpoint(self.checkpoint_path)
+        self._existing_products = {
+            product['attributes']['sku']: product for product in iter_products(self.get_token())
+        }
+
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        with open(self.checkpoint_path, 'a') as checkpoint, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for menu_item in menu_items:
+                slots.acquire()
+                future = executor.submit(self._import_product, menu_item, checkpoint)
+                future.add_done_callback(lambda _: slots.release())
+
+        self.report()
+
+        return self.stats
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        elapsed = time.monotonic() - self._started_at
+        processed = count_processed(stats)
+        logger.info(
+            f'Обработано товаров: {processed} за {elapsed:.1f} с ({processed / elapsed if elapsed else 0:.1f} в секунду), '
+            f'создано: {stats["created"]}, дополнено картинками: {stats["images_linked"]}, '
+            f'пропущено: {stats["skipped"]}, ошибок: {stats["failed"]}, '
+            f'картинок загружено: {stats["uploaded"]}, переиспользовано: {stats["reused"]}'
+        )
+
+    def _import_product(self, menu_item, checkpoint):
+        try:
+            sku, name, description, img_link = parse_menu_item(menu_item)
+            if sku in self._done_skus:
+                self._count('skipped')
+                return
+
+            product = self._existing_products.get(sku)
+            if product is not None and get_main_image_id(product):
+                counter = 'skipped'
+            else:
+                product_id = product['id'] if product is not None else \
+                    create_pcm_product(self.get_token(), sku, name, description)
+                set_main_image(self.get_token(), product_id, self._get_image_id(img_link))
+                counter = 'created' if product is None else 'images_linked'
+        except Exception:
+            logger.exception(f'Не удалось загрузить товар {menu_item.get("id")}')
+            self._count('failed')
+            return
+
+        with self._lock:
+            checkpoint.write(f'{sku}\n')
+            checkpoint.flush()
+        self._count(counter)
+
+    def _get_image_id(self, img_link):
+        with self._lock:
+            image = self._images.get(img_link)
+            is_owner = image is None
+            if is_owner:
+                image = self._images[img_link] = Future()
+
+        if not is_owner:
+            self._count('reused')
+            return image.result()
+
+        try:
+            image.set_result(upload_file(self.get_token(), img_link))
+        except Exception as error:
+            with self._lock:
+                del self._images[img_link]
+            image.set_exception(error)
+            raise
+
+        self._count('uploaded')
+        return image.result()
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+            processed = count_processed(self.stats)
+        if counter in PRODUCT_COUNTERS and processed % self.report_every == 0:
+            self.report()
+
+
+def count_processed(stats):
+    return sum(stats[counter] for counter in PRODUCT_COUNTERS)
+
+
+def iter_menu_items(menu_path):
+    with open(menu_path, encoding='utf-8') as menu_file:
+        first_char = menu_file.read(1)
+        menu_file.seek(0)
+        if first_char == '[':
+            yield from json.load(menu_file)
+            return
+
+        for line in menu_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_menu_item(menu_item):
+    return (
+        str(menu_item['id']),
+        menu_item['name'],
+        menu_item['description'],
+        menu_item['product_image']['url'],
+    )
+
+
+def get_main_image_id(product):
+    main_image = (product.get('relationships') or {}).get('main_image') or {}
+
+    return (main_image.get('data') or {}).get('id')
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+
+    with open(checkpoint_path) as checkpoint:
+        return {line.strip() for line in checkpoint if line.strip()}
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Загружает меню пиццерии в Moltin')
+    parser.add_argument('menu_path', help='JSON файл с массивом товаров или JSON Lines файл, по товару в строке')
+    parser.add_argument('--checkpoint', default='import_products.checkpoint', help='файл с уже загруженными SKU')
+    parser.add_argument('--workers', type=int, default=8, help='сколько товаров загружается одновременно')
+    parser.add_argument('--api-url', default=moltin.API_URL, help='адрес API Moltin')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    moltin.API_URL = args.api_url.rstrip('/')
+    configure_client(pool_maxsize=max(args.workers, 16))
+
+    client_id = os.getenv('MOLTIN_CLIENT_KEY')
+    client_secret = os.getenv('SECRET_KEY')
+    importer = ProductImporter(
+        lambda: get_moltin_token(client_id, client_secret),
+        args.checkpoint,
+        workers=args.workers,
+    )
+    importer.run(iter_menu_items(args.menu_path))
+
+
+if __name__ == '__main__':
+    main()
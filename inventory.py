@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger('shop_tg_bot')
+
+
+class StockTable:
+
+    def __init__(self, fetch_stocks, ttl=30, retry_interval=30):
+        self.fetch_stocks = fetch_stocks
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.sold_out_ids = frozenset()
+        self._stocks = None
+        self._refreshed_at = 0
+        self._retry_at = 0
+        self._is_failing = False
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_available(self, product_id):
+        return self._get_stocks().get(product_id)
+
+    def is_in_stock(self, product_id):
+        available = self.get_available(product_id)
+
+        return available is None or available > 0
+
+    def get_sold_out_ids(self):
+        self._get_stocks()
+
+        return self.sold_out_ids
+
+    def refresh(self):
+        try:
+            stocks = self.fetch_stocks()
+        except Exception:
+            with self._lock:
+                self._retry_at = time.monotonic() + self.retry_interval
+                is_new_failure = not self._is_failing
+                self._is_failing = True
+            if is_new_failure and self._stocks is None:
+                logger.warning('Остатки недоступны, показываем все товары', exc_info=True)
+            elif is_new_failure:
+                logger.warning('Не удалось обновить остатки, используем сохраненные', exc_info=True)
+            if self._stocks is None:
+                raise
+            return
+
+        sold_out_ids = frozenset(product_id for product_id, available in stocks.items() if available <= 0)
+        with self._lock:
+            self._stocks, self.sold_out_ids = stocks, sold_out_ids
+            self._refreshed_at = time.monotonic()
+            was_failing, self._is_failing = self._is_failing, False
+        if was_failing:
+            logger.info('Остатки снова обновляются')
+
+    def _get_stocks(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            return self._stocks or {}
+
+        if self._stocks is None:
+            with self._lock:
+                if self._refreshing:
+                    return {}
+                self._refreshing = True
+            try:
+                self.refresh()
+            except Exception:
+                return {}
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        elif now - self._refreshed_at > self.ttl:
+            self._refresh_in_background()
+
+        return self._stocks
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
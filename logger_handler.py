@@ -1,13 +1,137 @@
 import logging
+import queue
+import threading
+import time
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+sender_logger = logging.getLogger(__name__)
 
 
 class TelegramLogsHandler(logging.Handler):
 
-    def __init__(self, tg_bot, chat_id):
+    def __init__(
+            self,
+            tg_bot,
+            chat_id,
+            capacity=1000,
+            batch_size=20,
+            flush_interval=2,
+            min_send_interval=3,
+            dedup_window=300,
+    ):
         super().__init__()
         self.chat_id = chat_id
         self.tg_bot = tg_bot
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_send_interval = min_send_interval
+        self.dedup_window = dedup_window
+        self.dropped_count = 0
+        self.suppressed_count = 0
+        self._records = queue.Queue(maxsize=capacity)
+        self._last_sent = {}
+        self._repeats = {}
+        self._last_send_time = 0
+        self._stats_lock = threading.Lock()
+        self._sender = threading.Thread(target=self._send_forever, daemon=True)
+        self._sender.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.tg_bot.send_message(chat_id=self.chat_id, text=log_entry)
+        try:
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._records.put_nowait(log_entry)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped_count += 1
+
+    def close(self):
+        try:
+            self._records.put(None, timeout=self.flush_interval)
+        except queue.Full:
+            pass
+        self._sender.join(timeout=self.flush_interval + self.min_send_interval + 5)
+        super().close()
+
+    def _send_forever(self):
+        while True:
+            log_entries, is_closed = self._collect_batch()
+            self._send_batch(log_entries)
+            if is_closed:
+                return
+
+    def _collect_batch(self):
+        try:
+            log_entry = self._records.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return [], False
+        if log_entry is None:
+            return [], True
+
+        log_entries = [log_entry]
+        deadline = time.monotonic() + self.flush_interval
+        while len(log_entries) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                log_entry = self._records.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if log_entry is None:
+                return log_entries, True
+            log_entries.append(log_entry)
+
+        return log_entries, False
+
+    def _send_batch(self, log_entries):
+        now = time.monotonic()
+        expired_repeats = {}
+        for log_entry, sent_at in list(self._last_sent.items()):
+            if now - sent_at >= self.dedup_window:
+                del self._last_sent[log_entry]
+                expired_repeats[log_entry] = self._repeats.pop(log_entry, 0)
+
+        counts = {}
+        for log_entry in log_entries:
+            counts[log_entry] = counts.get(log_entry, 0) + 1
+
+        messages = []
+        for log_entry, count in counts.items():
+            if log_entry in self._last_sent:
+                self._repeats[log_entry] = self._repeats.get(log_entry, 0) + count
+                with self._stats_lock:
+                    self.suppressed_count += count
+                continue
+
+            count += expired_repeats.pop(log_entry, 0)
+            self._last_sent[log_entry] = now
+            messages.append(f'{log_entry}\n(повторилось {count} раз)' if count > 1 else log_entry)
+
+        for log_entry, repeats in expired_repeats.items():
+            if repeats:
+                messages.append(f'{log_entry}\n(повторилось еще {repeats} раз)')
+
+        with self._stats_lock:
+            dropped_count, self.dropped_count = self.dropped_count, 0
+        if dropped_count:
+            messages.append(f'Буфер логов переполнен, пропущено сообщений: {dropped_count}')
+
+        if messages:
+            self._send_text('\n\n'.join(messages))
+
+    def _send_text(self, text):
+        for start in range(0, len(text), TELEGRAM_MESSAGE_LIMIT):
+            delay = self._last_send_time + self.min_send_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.tg_bot.send_message(chat_id=self.chat_id, text=text[start:start + TELEGRAM_MESSAGE_LIMIT])
+            except Exception:
+                sender_logger.warning('Не удалось отправить логи в Telegram', exc_info=True)
+            self._last_send_time = time.monotonic()
@@ -1,20 +1,407 @@
-import datetime
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from circuit_breaker import get_circuit_breaker
+
+API_URL = 'https://api.moltin.com'
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+_client = None
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+_token_manager_options = {}
+
+_product_cards = OrderedDict()
+_product_cards_lock = threading.Lock()
+PRODUCT_CARDS_MAXSIZE = 256
+PRODUCT_CARD_TTL = 600
+
+_customers = OrderedDict()
+_customers_lock = threading.Lock()
+_customer_creation_locks = {}
+CUSTOMERS_MAXSIZE = 1024
+
+_cart_include_disabled_until = 0
+CART_INCLUDE_RECHECK_INTERVAL = 3600
+_cart_snapshots = OrderedDict()
+_cart_snapshots_lock = threading.Lock()
+CART_SNAPSHOTS_MAXSIZE = 1024
+CART_SNAPSHOT_TTL = 60
+
+_page_prefetcher = None
+PAGE_SIZE = 100
+
+CartItem = namedtuple('CartItem', ['id', 'product_id', 'name', 'description', 'unit_price', 'quantity', 'amount'])
+Cart = namedtuple('Cart', ['items', 'total'])
+
+
+class MoltinClient:
+
+    def __init__(
+            self,
+            pool_connections=4,
+            pool_maxsize=16,
+            retries=3,
+            backoff_factor=0.3,
+            timeout=(3.05, 10),
+    ):
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.requests_count = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        return get_circuit_breaker(get_endpoint_name(url)).call(
+            self._send, method, url, is_failure=is_server_error, **kwargs
+        )
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.requests_count += 1
+
+        response = self.session.request(method, url, **kwargs)
+
+        headers = kwargs.get('headers') or {}
+        authorization = headers.get('Authorization', '')
+        if response.status_code == 401 and authorization.startswith('Bearer '):
+            fresh_token = refresh_rejected_token(authorization[len('Bearer '):])
+            if fresh_token:
+                kwargs['headers'] = {**headers, 'Authorization': f'Bearer {fresh_token}'}
+                with self._lock:
+                    self.requests_count += 1
+                response = self.session.request(method, url, **kwargs)
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def get_stats(self):
+        pools = self.adapter.poolmanager.pools
+        connections_opened, pool_requests, idle_connections = 0, 0, 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections_opened += pool.num_connections
+            pool_requests += pool.num_requests
+            if pool.pool is not None:
+                idle_connections += sum(connection is not None for connection in list(pool.pool.queue))
+
+        return {
+            'requests': self.requests_count,
+            'pools': len(pools),
+            'connections_opened': connections_opened,
+            'connections_reused': max(pool_requests - connections_opened, 0),
+            'idle_connections': idle_connections,
+        }
 
-token_lifetime, access_token = None, None
+    def close(self):
+        self.session.close()
+
+
+class TokenManager:
+
+    def __init__(
+            self,
+            client_key,
+            secret_key,
+            refresh_ahead=120,
+            expiry_margin=10,
+            redis_db=None,
+            namespace='shop_bot:moltin_token',
+            lock_ttl=30,
+            lock_wait=60,
+    ):
+        self.client_key = client_key
+        self.secret_key = secret_key
+        self.refresh_ahead = refresh_ahead
+        self.expiry_margin = expiry_margin
+        self.redis_db = redis_db
+        self.token_key = f'{namespace}:{client_key}'
+        self.lock_key = f'{namespace}:{client_key}:lock'
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.refreshes_count = 0
+        self._access_token, self._expires = None, 0
+        self._previous_token = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._release_lock = redis_db.register_script(RELEASE_LOCK_SCRIPT) if redis_db is not None else None
+
+    def get_token(self):
+        if self._is_fresh():
+            return self._access_token
+
+        with self._lock:
+            if not self._is_fresh():
+                self._refresh()
+
+            return self._access_token
+
+    def owns(self, token):
+        return token in (self._access_token, self._previous_token)
+
+    def invalidate(self, stale_token=None):
+        with self._lock:
+            if stale_token is not None and stale_token != self._access_token:
+                return
+            if self._access_token is not None:
+                self._previous_token = self._access_token
+            self._access_token, self._expires = None, 0
+
+            if self.redis_db is not None:
+                shared_token = self._load_shared_token()
+                if shared_token and shared_token['access_token'] == stale_token:
+                    self.redis_db.delete(self.token_key)
+
+    def _is_fresh(self):
+        return self._access_token is not None and time.time() < self._expires - self.expiry_margin
+
+    def _refresh(self):
+        if self.redis_db is None:
+            self._set_token(*self._request_token())
+            return
+
+        if self._use_shared_token():
+            return
+
+        lock_value = uuid.uuid4().hex
+        waiting_until = time.monotonic() + self.lock_wait
+        while not self.redis_db.set(self.lock_key, lock_value, nx=True, ex=self.lock_ttl):
+            if time.monotonic() > waiting_until:
+                raise TimeoutError(f'Токен Moltin не обновлен другим процессом за {self.lock_wait} с')
+            time.sleep(0.2)
+            if self._use_shared_token():
+                return
+
+        try:
+            if self._use_shared_token():
+                return
+            access_token, expires = self._request_token()
+            shared_token = json.dumps({'access_token': access_token, 'expires': expires})
+            self.redis_db.set(self.token_key, shared_token, ex=max(int(expires - time.time()), 1))
+        finally:
+            self._release_lock(keys=[self.lock_key], args=[lock_value])
+        self._set_token(access_token, expires)
+
+    def _use_shared_token(self):
+        shared_token = self._load_shared_token()
+        if not shared_token or time.time() >= shared_token['expires'] - self.refresh_ahead:
+            return False
+
+        self._set_token(shared_token['access_token'], shared_token['expires'])
+        return True
+
+    def _request_token(self):
+        url = f'{API_URL}/oauth/access_token'
+        payload = {
+            'client_id': self.client_key,
+            'client_secret': self.secret_key,
+            'grant_type': 'client_credentials',
+        }
+        response = get_client().post(url, data=payload)
+        response.raise_for_status()
+        token_response = response.json()
+        self.refreshes_count += 1
 
+        return token_response['access_token'], token_response['expires']
 
-def get_entries(moltin_access_token, flow):
+    def _load_shared_token(self):
+        shared_token = self.redis_db.get(self.token_key)
+        if not shared_token:
+            return None
+
+        return json.loads(shared_token)
+
+    def _set_token(self, access_token, expires):
+        if self._access_token is not None and access_token != self._access_token:
+            self._previous_token = self._access_token
+        self._access_token, self._expires = access_token, expires
+        self._schedule_refresh()
+
+    def _schedule_refresh(self, delay=None):
+        if self._timer is not None:
+            self._timer.cancel()
+        if delay is None:
+            delay = max(self._expires - self.refresh_ahead - time.time(), 1)
+        self._timer = threading.Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception:
+                self._schedule_refresh(delay=10)
+
+
+def get_endpoint_name(url):
+    url_parts = urlsplit(url)
+    path_parts = url_parts.path.strip('/').split('/')
+
+    return f'{url_parts.netloc}/{"/".join(path_parts[:2])}'
+
+
+def is_server_error(response):
+    return response.status_code >= 500 or response.status_code == 429
+
+
+def configure_token_manager(**token_manager_options):
+    with _token_managers_lock:
+        _token_manager_options.update(token_manager_options)
+        _token_managers.clear()
+
+
+def get_token_manager(client_key, secret_key):
+    with _token_managers_lock:
+        token_manager = _token_managers.get(client_key)
+        if token_manager is None:
+            token_manager = TokenManager(client_key, secret_key, **_token_manager_options)
+            _token_managers[client_key] = token_manager
+
+    return token_manager
+
+
+def refresh_rejected_token(stale_token):
+    with _token_managers_lock:
+        token_managers = list(_token_managers.values())
+
+    for token_manager in token_managers:
+        if token_manager.owns(stale_token):
+            token_manager.invalidate(stale_token)
+            return token_manager.get_token()
+
+    return None
+
+
+def configure_client(**client_options):
+    global _client
+
+    if _client is not None:
+        _client.close()
+    _client = MoltinClient(**client_options)
+
+    return _client
+
+
+def get_client():
+    global _client
+
+    if _client is None:
+        _client = MoltinClient()
+
+    return _client
+
+
+def get_page_prefetcher():
+    global _page_prefetcher
+
+    if _page_prefetcher is None:
+        _page_prefetcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='moltin-pages')
+
+    return _page_prefetcher
+
+
+def iter_pages(url, headers, params=None, page_size=PAGE_SIZE, prefetch=True):
+    params = dict(params or {}, **{'page[limit]': page_size, 'page[offset]': 0})
+    page = fetch_page(url, params, headers)
+    next_page = None
+    try:
+        while True:
+            next_request = get_next_page_request(page, url, params, page_size)
+            if next_request is not None and prefetch:
+                next_page = get_page_prefetcher().submit(fetch_page, *next_request, headers)
+
+            yield page['data']
+
+            if next_request is None:
+                return
+            if next_page is not None:
+                page, next_page = next_page.result(), None
+            else:
+                page = fetch_page(*next_request, headers)
+            url, params = next_request
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+def fetch_page(url, params, headers):
+    response = get_client().get(url, headers=headers, params=params)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def get_next_page_request(page, url, params, page_size):
+    if not page['data']:
+        return None
+
+    links = page.get('links') or {}
+    if 'next' in links:
+        next_url = links['next']
+        if not next_url or next_url == links.get('current'):
+            return None
+        return next_url, None
+
+    if params is None or len(page['data']) < page_size:
+        return None
+
+    return url, dict(params, **{'page[offset]': params['page[offset]'] + page_size})
+
+
+def iter_entries(moltin_access_token, flow, page_size=PAGE_SIZE):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
     }
-    url = f'https://api.moltin.com/v2/flows/{flow}/entries'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    url = f'{API_URL}/v2/flows/{flow}/entries'
+    for entries in iter_pages(url, headers, page_size=page_size):
+        yield from entries
 
-    return response.json()['data']
+
+def get_entries(moltin_access_token, flow):
+    return list(iter_entries(moltin_access_token, flow))
 
 
 def get_customer_address(moltin_access_token, flow, id):
@@ -22,9 +409,9 @@ def get_customer_address(moltin_access_token, flow, id):
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
     }
-    url = f'https://api.moltin.com/v2/flows/{flow}/entries/{id}'
+    url = f'{API_URL}/v2/flows/{flow}/entries/{id}'
 
-    response = requests.get(url, headers=headers)
+    response = get_client().get(url, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']
@@ -43,8 +430,8 @@ def create_customer_address(moltin_access_token, flow, longitude, latitude, tele
             'lat': latitude,
         }
     }
-    url = f'https://api.moltin.com/v2/flows/{flow}/entries'
-    response = requests.post(url, json=payload, headers=headers)
+    url = f'{API_URL}/v2/flows/{flow}/entries'
+    response = get_client().post(url, json=payload, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']['id']
@@ -64,13 +451,50 @@ def create_shop_address(moltin_access_token, flow, address, alias, longitude, la
             'Latitude': latitude,
         }
     }
-    url = f'https://api.moltin.com/v2/flows/{flow}/entries'
-    response = requests.post(url, json=payload, headers=headers)
+    url = f'{API_URL}/v2/flows/{flow}/entries'
+    response = get_client().post(url, json=payload, headers=headers)
     response.raise_for_status()
 
+    return response.json()['data']
+
+
+def update_shop_address(moltin_access_token, flow, id, address, alias, longitude, latitude):
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        'data': {
+            'type': 'entry',
+            'id': id,
+            'Address': address,
+            'Alias': alias,
+            'Longitude': longitude,
+            'Latitude': latitude,
+        }
+    }
+    url = f'{API_URL}/v2/flows/{flow}/entries/{id}'
+    response = get_client().put(url, json=payload, headers=headers)
+    response.raise_for_status()
+
+    return response.json()['data']
+
+
+def find_flow(moltin_access_token, slug):
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}',
+    }
+    url = f'{API_URL}/v2/flows'
+    for flows in iter_pages(url, headers):
+        for flow in flows:
+            if flow['slug'] == slug:
+                return flow
+
+    return None
+
 
 def create_flow(moltin_access_token):
-    url = 'https://api.moltin.com/v2/flows'
+    url = f'{API_URL}/v2/flows'
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
@@ -84,37 +508,55 @@ def create_flow(moltin_access_token):
             'enabled': True
         }
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = get_client().post(url, json=payload, headers=headers)
     response.raise_for_status()
     flow_id = response.json()['data']['id']
 
-    url = 'https://api.moltin.com/v2/fields'
     fields = ['Address', 'Alias', 'Longitude', 'Latitude']
-    for field in fields:
-        payload = {
-            'data': {
-                'type': 'field',
-                'name': field,
-                'slug': field,
-                'field_type': 'string',
-                'description': '',
-                'required': False,
-                'enabled': True,
-                'relationships': {
-                    'flow': {
-                        'data': {
-                            'type': 'flow',
-                            'id': flow_id
-                        }
+    with ThreadPoolExecutor(max_workers=len(fields)) as executor:
+        list(executor.map(partial(create_flow_field, moltin_access_token, flow_id), fields))
+
+    return flow_id
+
+
+def create_flow_field(moltin_access_token, flow_id, field):
+    url = f'{API_URL}/v2/fields'
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        'data': {
+            'type': 'field',
+            'name': field,
+            'slug': field,
+            'field_type': 'string',
+            'description': '',
+            'required': False,
+            'enabled': True,
+            'relationships': {
+                'flow': {
+                    'data': {
+                        'type': 'flow',
+                        'id': flow_id
                     }
                 }
             }
         }
-        requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
+    }
+    response = get_client().post(url, json=payload, headers=headers)
+    response.raise_for_status()
+
 
 def create_product(moltin_access_token, img_link, sku, name, description):
-    url = 'https://api.moltin.com/pcm/products'
+    product_id = create_pcm_product(moltin_access_token, sku, name, description)
+    set_main_image(moltin_access_token, product_id, upload_file(moltin_access_token, img_link))
+
+    return product_id
+
+
+def create_pcm_product(moltin_access_token, sku, name, description):
+    url = f'{API_URL}/pcm/products'
     payload = {
         'data': {
             'type': 'product',
@@ -132,22 +574,28 @@ def create_product(moltin_access_token, img_link, sku, name, description):
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = get_client().post(url, json=payload, headers=headers)
     response.raise_for_status()
-    product_id = response.json()['data']['id']
 
+    return response.json()['data']['id']
+
+
+def upload_file(moltin_access_token, img_link):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}'
     }
     payload = {
         'file_location': (None, img_link)
     }
-    url = 'https://api.moltin.com/v2/files'
-    response = requests.post(url, headers=headers, files=payload)
+    url = f'{API_URL}/v2/files'
+    response = get_client().post(url, headers=headers, files=payload)
     response.raise_for_status()
-    img_id = response.json()['data']['id']
 
-    url = f'https://api.moltin.com/pcm/products/{product_id}/relationships/main_image'
+    return response.json()['data']['id']
+
+
+def set_main_image(moltin_access_token, product_id, img_id):
+    url = f'{API_URL}/pcm/products/{product_id}/relationships/main_image'
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
@@ -158,12 +606,12 @@ def create_product(moltin_access_token, img_link, sku, name, description):
             'id': img_id
         }
     }
-    requests.post(url, headers=headers, json=payload)
+    response = get_client().post(url, headers=headers, json=payload)
     response.raise_for_status()
 
 
 def add_product_to_cart(moltin_access_token, product_id, amount, customer_id):
-    url = f'https://api.moltin.com/v2/carts/{customer_id}/items'
+    url = f'{API_URL}/v2/carts/{customer_id}/items'
 
     payload = {
         'data': {
@@ -176,69 +624,128 @@ def add_product_to_cart(moltin_access_token, product_id, amount, customer_id):
         'Authorization': f'Bearer {moltin_access_token}',
         'Content-Type': 'application/json'
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = get_client().post(url, json=payload, headers=headers)
+    invalidate_cart_snapshot(customer_id)
     response.raise_for_status()
 
 
 def get_cart_items(moltin_access_token, customer_id):
-    url = f'https://api.moltin.com/v2/carts/{customer_id}/items'
+    global _cart_include_disabled_until
+
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
     }
-    response = requests.get(url, headers=headers)
+    url = f'{API_URL}/v2/carts/{customer_id}'
+    if time.monotonic() >= _cart_include_disabled_until:
+        payload = {
+            'include': 'items'
+        }
+        response = get_client().get(url, headers=headers, params=payload)
+        if response.status_code != 400:
+            response.raise_for_status()
+            cart = response.json()
+            cart_items = (cart.get('included') or {}).get('items')
+            if cart_items is None and not get_related_item_ids(cart):
+                cart_items = []
+            elif cart_items is None:
+                _cart_include_disabled_until = time.monotonic() + CART_INCLUDE_RECHECK_INTERVAL
+                cart_items = fetch_cart_items(moltin_access_token, customer_id)
+
+            return cart_items, cart['data']['meta']['display_price']['with_tax']['amount']
+
+        _cart_include_disabled_until = time.monotonic() + CART_INCLUDE_RECHECK_INTERVAL
+
+    cart_items = get_page_prefetcher().submit(fetch_cart_items, moltin_access_token, customer_id)
+    response = get_client().get(url, headers=headers)
     response.raise_for_status()
-    cart_items = response.json()['data']
+    items_sum = response.json()['data']['meta']['display_price']['with_tax']['amount']
+
+    return cart_items.result(), items_sum
 
-    url = f'https://api.moltin.com/v2/carts/{customer_id}'
+
+def get_related_item_ids(cart):
+    relationships = cart['data'].get('relationships') or {}
+    related_items = (relationships.get('items') or {}).get('data') or []
+
+    return [related_item['id'] for related_item in related_items]
+
+
+def fetch_cart_items(moltin_access_token, customer_id):
+    url = f'{API_URL}/v2/carts/{customer_id}/items'
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
     }
-    response = requests.get(url, headers=headers)
+    response = get_client().get(url, headers=headers)
     response.raise_for_status()
-    items_sum = response.json()['data']['meta']['display_price']['with_tax']['amount']
 
-    return cart_items, items_sum
+    return response.json()['data']
 
 
-def get_moltin_token(client_key, secret_key):
-    global token_lifetime, access_token
+def get_cart_snapshot(moltin_access_token, customer_id):
+    customer_id = str(customer_id)
+    now = time.monotonic()
+    with _cart_snapshots_lock:
+        cached_snapshot = _cart_snapshots.get(customer_id)
+        if cached_snapshot and cached_snapshot[0] > now:
+            _cart_snapshots.move_to_end(customer_id)
+            return cached_snapshot[1]
 
-    url = 'https://api.moltin.com/oauth/access_token'
+    cart = parse_cart(*get_cart_items(moltin_access_token, customer_id))
 
-    payload = {
-        'client_id': client_key,
-        'client_secret': secret_key,
-        'grant_type': 'client_credentials',
-    }
+    with _cart_snapshots_lock:
+        _cart_snapshots[customer_id] = (now + CART_SNAPSHOT_TTL, cart)
+        _cart_snapshots.move_to_end(customer_id)
+        while len(_cart_snapshots) > CART_SNAPSHOTS_MAXSIZE:
+            _cart_snapshots.popitem(last=False)
 
-    time_label = datetime.datetime.now().timestamp()
-    if token_lifetime is None or token_lifetime <= time_label:
-        response = requests.post(url, data=payload)
-        response.raise_for_status()
-        token_response = response.json()
-        access_token = token_response['access_token']
-        token_lifetime = token_response['expires']
+    return cart
 
-    return access_token
 
+def invalidate_cart_snapshot(customer_id):
+    with _cart_snapshots_lock:
+        _cart_snapshots.pop(str(customer_id), None)
 
-def get_products(moltin_access_token):
-    url = 'https://api.moltin.com/pcm/products'
+
+def parse_cart(cart_items, items_sum):
+    items = tuple(
+        CartItem(
+            id=item['id'],
+            product_id=item.get('product_id'),
+            name=item['name'],
+            description=item['description'],
+            unit_price=item['unit_price']['amount'],
+            quantity=item['quantity'],
+            amount=item['value']['amount'],
+        )
+        for item in cart_items
+    )
+
+    return Cart(items, items_sum)
+
+
+def get_moltin_token(client_key, secret_key):
+    return get_token_manager(client_key, secret_key).get_token()
+
+
+def iter_products(moltin_access_token, page_size=PAGE_SIZE):
+    url = f'{API_URL}/pcm/products'
     headers = {
         'Authorization': f'Bearer {moltin_access_token}'
     }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    for products in iter_pages(url, headers, page_size=page_size):
+        yield from products
 
-    return response.json()['data']
+
+def get_products(moltin_access_token):
+    return list(iter_products(moltin_access_token))
 
 
 def get_product(moltin_access_token, product_id):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
     }
-    product_url = f'https://api.moltin.com/pcm/products/{product_id}'
-    response = requests.get(product_url, headers=headers)
+    product_url = f'{API_URL}/pcm/products/{product_id}'
+    response = get_client().get(product_url, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']
@@ -248,13 +755,27 @@ def get_stock(moltin_access_token, product_id):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
     }
-    product_url = f'https://api.moltin.com/v2/inventories/{product_id}'
-    response = requests.get(product_url, headers=headers)
+    product_url = f'{API_URL}/v2/inventories/{product_id}'
+    response = get_client().get(product_url, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']['available']
 
 
+def iter_stocks(moltin_access_token, page_size=PAGE_SIZE):
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}',
+    }
+    url = f'{API_URL}/v2/inventories'
+    for inventories in iter_pages(url, headers, page_size=page_size):
+        for inventory in inventories:
+            yield inventory['id'], inventory['available']
+
+
+def get_stocks(moltin_access_token):
+    return dict(iter_stocks(moltin_access_token))
+
+
 def get_price(moltin_access_token, product_id):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
@@ -262,8 +783,8 @@ def get_price(moltin_access_token, product_id):
     payload = {
         'include': 'prices'
     }
-    product_url = f'https://api.moltin.com/catalog/products/{product_id}'
-    response = requests.get(product_url, headers=headers, params=payload)
+    product_url = f'{API_URL}/catalog/products/{product_id}'
+    response = get_client().get(product_url, headers=headers, params=payload)
     response.raise_for_status()
     price = response.json()['data']['attributes']['price']
 
@@ -275,13 +796,13 @@ def get_product_image(moltin_access_token, product_id):
         'Authorization': f'Bearer {moltin_access_token}',
     }
 
-    url = f'https://api.moltin.com/pcm/products/{product_id}/relationships/main_image'
-    response = requests.get(url, headers=headers)
+    url = f'{API_URL}/pcm/products/{product_id}/relationships/main_image'
+    response = get_client().get(url, headers=headers)
     response.raise_for_status()
     image_id = response.json()['data']['id']
 
-    url = f'https://api.moltin.com/v2/files/{image_id}'
-    response = requests.get(url, headers=headers)
+    url = f'{API_URL}/v2/files/{image_id}'
+    response = get_client().get(url, headers=headers)
     response.raise_for_status()
 
     image_link = response.json()['data']['link']['href']
@@ -289,29 +810,140 @@ def get_product_image(moltin_access_token, product_id):
     return image_link
 
 
+def get_product_card(moltin_access_token, product_id):
+    now = time.monotonic()
+    with _product_cards_lock:
+        cached_card = _product_cards.get(product_id)
+        if cached_card and cached_card[0] > now:
+            _product_cards.move_to_end(product_id)
+            return cached_card[1]
+
+    card = fetch_catalog_product_card(moltin_access_token, product_id)
+
+    with _product_cards_lock:
+        _product_cards[product_id] = (now + PRODUCT_CARD_TTL, card)
+        _product_cards.move_to_end(product_id)
+        while len(_product_cards) > PRODUCT_CARDS_MAXSIZE:
+            _product_cards.popitem(last=False)
+
+    return card
+
+
+def invalidate_product_card(product_id=None):
+    with _product_cards_lock:
+        if product_id is None:
+            _product_cards.clear()
+        else:
+            _product_cards.pop(product_id, None)
+
+
+def fetch_catalog_product_card(moltin_access_token, product_id):
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}',
+    }
+    payload = {
+        'include': 'prices,main_image'
+    }
+    url = f'{API_URL}/catalog/products/{product_id}'
+    response = get_client().get(url, headers=headers, params=payload)
+    response.raise_for_status()
+    catalog_product = response.json()
+
+    product = catalog_product['data']
+    main_image = product.get('relationships', {}).get('main_image', {}).get('data') or {}
+    image_id, image_link = main_image.get('id'), None
+    for image in catalog_product.get('included', {}).get('main_images', []):
+        if image['id'] == image_id:
+            image_link = image['link']['href']
+            break
+
+    if image_id and not image_link:
+        url = f'{API_URL}/v2/files/{image_id}'
+        response = get_client().get(url, headers=headers)
+        response.raise_for_status()
+        image_link = response.json()['data']['link']['href']
+
+    return {
+        'id': product_id,
+        'name': product['attributes']['name'],
+        'description': product['attributes'].get('description', ''),
+        'price': product['attributes']['price'],
+        'image_id': image_id,
+        'image_link': image_link,
+    }
+
+
 def delete_cart_item(moltin_access_token, chat_id, product_id):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}',
     }
-    cart_url = f'https://api.moltin.com/v2/carts/{chat_id}/items/{product_id}'
-    response = requests.delete(cart_url, headers=headers)
+    cart_url = f'{API_URL}/v2/carts/{chat_id}/items/{product_id}'
+    response = get_client().delete(cart_url, headers=headers)
+    invalidate_cart_snapshot(chat_id)
     response.raise_for_status()
 
 
 def create_and_check_customer(moltin_access_token, name, email):
+    email_key = email.strip().lower()
+    customer = get_cached_customer(email_key)
+    if customer is not None:
+        return customer
+
+    with _customers_lock:
+        creation_lock = _customer_creation_locks.setdefault(email_key, threading.Lock())
+
+    with creation_lock:
+        try:
+            customer = get_cached_customer(email_key)
+            if customer is None:
+                customer = find_customer(moltin_access_token, email)
+                if customer is None:
+                    customer = create_customer(moltin_access_token, name, email)
+                cache_customer(email_key, customer)
+        finally:
+            with _customers_lock:
+                _customer_creation_locks.pop(email_key, None)
+
+    return customer
+
+
+def get_cached_customer(email_key):
+    with _customers_lock:
+        customer = _customers.get(email_key)
+        if customer is not None:
+            _customers.move_to_end(email_key)
+
+    return customer
+
+
+def cache_customer(email_key, customer):
+    with _customers_lock:
+        _customers[email_key] = customer
+        _customers.move_to_end(email_key)
+        while len(_customers) > CUSTOMERS_MAXSIZE:
+            _customers.popitem(last=False)
+
+
+def iter_customers(moltin_access_token, email=None, page_size=PAGE_SIZE, prefetch=True):
     headers = {
         'Authorization': f'Bearer {moltin_access_token}'
     }
+    payload = {}
+    if email is not None:
+        payload['filter'] = f'eq(email,{email})'
+    url = f'{API_URL}/v2/customers'
+    for customers in iter_pages(url, headers, params=payload, page_size=page_size, prefetch=prefetch):
+        yield from customers
 
-    url = 'https://api.moltin.com/v2/customers'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
 
-    customers = response.json()['data']
-    for customer in customers:
-        if customer['name'] == name and customer['email'] == email:
-            return customer
+def find_customer(moltin_access_token, email):
+    return next(iter_customers(moltin_access_token, email, page_size=1, prefetch=False), None)
 
+
+def create_customer(moltin_access_token, name, email):
+    headers = {
+        'Authorization': f'Bearer {moltin_access_token}'
+    }
     payload = {
         'data': {
             'type': 'customer',
@@ -320,14 +952,8 @@ def create_and_check_customer(moltin_access_token, name, email):
             'password': '',
         },
     }
-
-    url = 'https://api.moltin.com/v2/customers'
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    customer_id = response.json()['data']['id']
-
-    url = f'https://api.moltin.com/v2/customers/{customer_id}'
-    response = requests.get(url, headers=headers)
+    url = f'{API_URL}/v2/customers'
+    response = get_client().post(url, headers=headers, json=payload)
     response.raise_for_status()
 
     return response.json()['data']
@@ -0,0 +1,29 @@
+import json
+
+
+class ProductPhotoCache:
+
+    def __init__(self, redis_db, key='shop_bot:product_photos'):
+        self.redis_db = redis_db
+        self.key = key
+
+    def get_file_id(self, product_id, image_id):
+        cached_photo = self.redis_db.hget(self.key, product_id)
+        if not cached_photo:
+            return None
+
+        cached_photo = json.loads(cached_photo)
+        if cached_photo['image_id'] != image_id:
+            self.invalidate(product_id)
+            return None
+
+        return cached_photo['file_id']
+
+    def save_file_id(self, product_id, image_id, file_id):
+        self.redis_db.hset(self.key, product_id, json.dumps({'image_id': image_id, 'file_id': file_id}))
+
+    def invalidate(self, product_id=None):
+        if product_id is None:
+            self.redis_db.delete(self.key)
+        else:
+            self.redis_db.hdel(self.key, product_id)
@@ -0,0 +1,142 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('shop_tg_bot')
+
+CLAIM_DUE_SCRIPT = '''
+local reminders = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, reminder in ipairs(reminders) do
+    redis.call('zrem', KEYS[1], reminder)
+    redis.call('zadd', KEYS[2], ARGV[3], reminder)
+end
+return reminders
+'''
+RESCHEDULE_SCRIPT = '''
+if redis.call('zrem', KEYS[1], ARGV[1]) == 1 then
+    redis.call('zadd', KEYS[2], ARGV[3], ARGV[2])
+    return 1
+end
+return 0
+'''
+
+
+class ReminderScheduler:
+
+    def __init__(
+            self,
+            redis_db,
+            send_reminder,
+            namespace='shop_bot:reminders',
+            batch_size=100,
+            poll_interval=1,
+            visibility_timeout=60,
+            max_attempts=5,
+            retry_delay=60,
+    ):
+        self.redis_db = redis_db
+        self.send_reminder = send_reminder
+        self.pending_key = f'{namespace}:pending'
+        self.inflight_key = f'{namespace}:inflight'
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.stats = {'scheduled': 0, 'fired': 0, 'failed': 0, 'dropped': 0, 'requeued': 0, 'lag_seconds': 0.0, 'max_lag_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._claim_due = redis_db.register_script(CLAIM_DUE_SCRIPT)
+        self._move_to_pending = redis_db.register_script(RESCHEDULE_SCRIPT)
+
+    def schedule(self, chat_id, delay):
+        due = time.time() + delay
+        reminder = json.dumps({'id': uuid.uuid4().hex, 'chat_id': chat_id, 'due': due})
+        self.redis_db.zadd(self.pending_key, {reminder: due})
+        with self._lock:
+            self.stats['scheduled'] += 1
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                fired_count = self.process_due()
+            except Exception:
+                logger.exception('Не удалось обработать напоминания')
+                fired_count = 0
+            if fired_count < self.batch_size:
+                self._stopped.wait(self.poll_interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def process_due(self):
+        now = time.time()
+        self._requeue_expired(now)
+
+        claimed_reminders = self._claim(self.pending_key, now)
+
+        fired_count = 0
+        for reminder in claimed_reminders:
+            reminder_data = json.loads(reminder)
+            try:
+                self.send_reminder(reminder_data['chat_id'])
+            except Exception:
+                logger.warning(f'Не удалось отправить напоминание в чат {reminder_data["chat_id"]}', exc_info=True)
+                with self._lock:
+                    self.stats['failed'] += 1
+                self._reschedule(reminder, reminder_data)
+                continue
+
+            self.redis_db.zrem(self.inflight_key, reminder)
+            fired_count += 1
+            lag = time.time() - reminder_data['due']
+            with self._lock:
+                self.stats['fired'] += 1
+                self.stats['lag_seconds'] += lag
+                self.stats['max_lag_seconds'] = max(self.stats['max_lag_seconds'], lag)
+
+        return fired_count
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_lag_seconds'] = stats.pop('lag_seconds') / stats['fired'] if stats['fired'] else 0
+        stats['pending'] = self.redis_db.zcard(self.pending_key)
+        stats['inflight'] = self.redis_db.zcard(self.inflight_key)
+
+        return stats
+
+    def _claim(self, key, now):
+        return self._claim_due(
+            keys=[key, self.inflight_key],
+            args=[now, self.batch_size, now + self.visibility_timeout],
+        )
+
+    def _reschedule(self, reminder, reminder_data):
+        attempts = reminder_data.get('attempts', 0) + 1
+        if attempts >= self.max_attempts:
+            if self.redis_db.zrem(self.inflight_key, reminder):
+                logger.warning(f'Напоминание в чат {reminder_data["chat_id"]} не отправлено после {attempts} попыток')
+                with self._lock:
+                    self.stats['dropped'] += 1
+            return
+
+        reminder_data['attempts'] = attempts
+        self._move_to_pending(
+            keys=[self.inflight_key, self.pending_key],
+            args=[reminder, json.dumps(reminder_data), time.time() + self.retry_delay * attempts],
+        )
+
+    def _requeue_expired(self, now):
+        for reminder in self._claim(self.inflight_key, now):
+            self._reschedule(reminder, json.loads(reminder))
+            with self._lock:
+                self.stats['requeued'] += 1
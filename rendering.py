@@ -0,0 +1,82 @@
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+CART_ITEM_SEPARATOR = '_' * 58
+
+_menu_keyboards = {}
+_menu_keyboards_version = None
+_menu_keyboards_lock = threading.Lock()
+
+
+def get_menu_keyboard(products, catalog_version, with_cart_button=True, sold_out_ids=frozenset()):
+    global _menu_keyboards_version
+
+    with _menu_keyboards_lock:
+        if catalog_version != _menu_keyboards_version:
+            _menu_keyboards.clear()
+            _menu_keyboards_version = catalog_version
+
+        keyboard_key = (with_cart_button, sold_out_ids)
+        reply_markup = _menu_keyboards.get(keyboard_key)
+        if reply_markup is None or catalog_version is None:
+            reply_markup = build_menu_keyboard(products, with_cart_button, sold_out_ids)
+            for cached_key in [key for key in _menu_keyboards if key[1] != sold_out_ids]:
+                del _menu_keyboards[cached_key]
+            _menu_keyboards[keyboard_key] = reply_markup
+
+    return reply_markup
+
+
+def build_menu_keyboard(products, with_cart_button, sold_out_ids=frozenset()):
+    keyboard = [[InlineKeyboardButton(
+        f'{product["attributes"]["name"]} (нет в наличии)' if product['id'] in sold_out_ids
+        else product['attributes']['name'],
+        callback_data=product['id']
+    )] for product in products]
+    if with_cart_button:
+        keyboard.append([InlineKeyboardButton('Корзина', callback_data='Корзина')])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+def render_cart_items(cart):
+    lines = []
+    for item in cart.items:
+        lines.append(
+            f'\n{item.name}\n'
+            f'{item.description}\n'
+            f'Цена: {item.unit_price} Руб.\n'
+            f'{item.quantity} шт. в корзине - {item.amount} Руб.\n'
+            f'{CART_ITEM_SEPARATOR}\n'
+        )
+
+    return ''.join(lines)
+
+
+def render_cart(cart):
+    keyboard = []
+    if cart.items:
+        text = f'{render_cart_items(cart)}\nИтого: {cart.total} Руб.'
+        for item in cart.items:
+            keyboard.append([InlineKeyboardButton(f'Убрать из корзины {item.name}', callback_data=f'Убрать {item.id}')])
+        keyboard.append([InlineKeyboardButton('Оплатить', callback_data='Оплатить')])
+    else:
+        text = 'Пожалуйста, перейдите в меню и выберите товар.'
+    keyboard.append([InlineKeyboardButton('В меню', callback_data='В меню')])
+
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def render_order(cart, shipping_cost):
+    if not cart.items:
+        return 'Ваш заказ:\n', 0
+
+    total_amount = cart.total + int(shipping_cost)
+    text = (
+        f'Ваш заказ:\n{render_cart_items(cart)}'
+        f'\nДоставка: {shipping_cost} Руб.\n'
+        f'\nК оплате: {total_amount} Руб.'
+    )
+
+    return text, total_amount
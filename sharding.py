@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+
+from webhook_server import get_update_chat_id
+
+logger = logging.getLogger('shop_tg_bot')
+
+RENEW_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RELEASE_LEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+class UpdateStreamPublisher:
+
+    def __init__(self, redis_db, shards, namespace='shop_bot:updates', max_length=100000):
+        self.redis_db = redis_db
+        self.shards = shards
+        self.namespace = namespace
+        self.max_length = max_length
+        self.stats = {'published': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def publish(self, update_json):
+        shard = get_shard(get_update_chat_id(update_json), self.shards)
+        try:
+            self.redis_db.xadd(
+                get_stream_name(self.namespace, shard),
+                {'update': json.dumps(update_json)},
+                maxlen=self.max_length,
+                approximate=True,
+            )
+        except redis.RedisError:
+            logger.warning('Не удалось передать обновление воркерам', exc_info=True)
+            self._count('failed')
+            return False
+
+        self._count('published')
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['backlog'] = [
+            self.redis_db.xlen(get_stream_name(self.namespace, shard)) for shard in range(self.shards)
+        ]
+
+        return stats
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+
+class ShardWorker:
+
+    def __init__(
+            self,
+            redis_db,
+            shard,
+            process_update,
+            namespace='shop_bot:updates',
+            group='workers',
+            batch_size=50,
+            block_ms=5000,
+            claim_idle_ms=60000,
+            claim_interval=60,
+            lease_ttl=30,
+            max_backoff=30,
+    ):
+        self.redis_db = redis_db
+        self.stream = get_stream_name(namespace, shard)
+        self.owner_key = f'{self.stream}:owner'
+        self.process_update = process_update
+        self.group = group
+        self.consumer = f'{socket.gethostname()}-{os.getpid()}-{shard}'
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.claim_interval = claim_interval
+        self.lease_ttl = lease_ttl
+        self.max_backoff = max_backoff
+        self.stats = {'processed': 0, 'failed': 0, 'reclaimed': 0, 'redis_errors': 0, 'leases_lost': 0}
+        self._stopped = threading.Event()
+        self._lease_lost = threading.Event()
+        self._renew_lease = redis_db.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = redis_db.register_script(RELEASE_LEASE_SCRIPT)
+
+    def run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                if not self._acquire_shard():
+                    logger.warning(f'Поток {self.stream} уже обрабатывает другой воркер, ждем')
+                    self._stopped.wait(self.lease_ttl)
+                    continue
+                self._consume()
+                backoff = 1
+            except redis.ConnectionError:
+                self.stats['redis_errors'] += 1
+                logger.warning(f'Потеряно соединение с Redis при чтении {self.stream}, повтор через {backoff} с')
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        self._release_shard()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _consume(self):
+        try:
+            self.redis_db.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+
+        self._lease_lost.clear()
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        try:
+            # entries left pending by the previous owner are older than anything behind '>'
+            self._process_messages(self._claim_abandoned_messages(min_idle_time=0))
+            claimed_at = time.monotonic()
+            while not self._stopped.is_set() and not self._lease_lost.is_set():
+                if time.monotonic() - claimed_at > self.claim_interval:
+                    self._process_messages(self._claim_abandoned_messages(self.claim_idle_ms))
+                    claimed_at = time.monotonic()
+
+                response = self.redis_db.xreadgroup(
+                    self.group,
+                    self.consumer,
+                    {self.stream: '>'},
+                    count=self.batch_size,
+                    block=self.block_ms,
+                )
+                for _, messages in response:
+                    self._process_messages(messages)
+        finally:
+            self._lease_lost.set()
+            heartbeat.join()
+
+    def _heartbeat(self):
+        while not self._lease_lost.wait(self.lease_ttl / 3):
+            try:
+                is_renewed = self._renew_lease(keys=[self.owner_key], args=[self.consumer, self.lease_ttl])
+            except redis.RedisError:
+                logger.warning(f'Не удалось продлить владение потоком {self.stream}', exc_info=True)
+                is_renewed = False
+            if not is_renewed:
+                self.stats['leases_lost'] += 1
+                self._lease_lost.set()
+
+    def _acquire_shard(self):
+        if self.redis_db.set(self.owner_key, self.consumer, nx=True, ex=self.lease_ttl):
+            return True
+
+        return bool(self._renew_lease(keys=[self.owner_key], args=[self.consumer, self.lease_ttl]))
+
+    def _release_shard(self):
+        try:
+            self._release_lease(keys=[self.owner_key], args=[self.consumer])
+        except redis.RedisError:
+            pass
+
+    def _claim_abandoned_messages(self, min_idle_time):
+        claimed_messages = []
+        start_id = '0-0'
+        while True:
+            start_id, messages = self.redis_db.xautoclaim(
+                self.stream,
+                self.group,
+                self.consumer,
+                min_idle_time=min_idle_time,
+                start_id=start_id,
+                count=self.batch_size * 10,
+            )[:2]
+            claimed_messages.extend(messages)
+            if start_id in (b'0-0', '0-0'):
+                break
+        self.stats['reclaimed'] += len(claimed_messages)
+
+        return claimed_messages
+
+    def _process_messages(self, messages):
+        for message_id, fields in messages:
+            if self._lease_lost.is_set():
+                return
+            try:
+                self.process_update(json.loads(fields[b'update']))
+                self.stats['processed'] += 1
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception('Не удалось обработать обновление из очереди')
+            self.redis_db.xack(self.stream, self.group, message_id)
+
+
+def get_shard(chat_id, shards):
+    return int(chat_id) % shards
+
+
+def get_stream_name(namespace, shard):
+    return f'{namespace}:{shard}'
@@ -1,60 +1,74 @@
 import os
 import logging
 import textwrap
+import threading
 from functools import partial
 
 import redis
+import requests
 import telegram
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 
 from telegram.ext import Filters, Updater, PreCheckoutQueryHandler
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
 
-from geolocation_tools import fetch_coordinates, get_nearest_pizzeria
+from cart import LocalCartStore
+from circuit_breaker import CircuitOpenError, configure_circuit_breakers, get_circuit_breakers_stats
+from catalog_cache import ProductCatalogCache
+from inventory import StockTable
+from geolocation_tools import configure_geocode_cache, configure_geocoder_rate_limit, fetch_coordinates, \
+    get_delivery_cost, get_nearest_pizzeria
 from logger_handler import TelegramLogsHandler
 from dotenv import load_dotenv
 
-from moltin import get_moltin_token, get_products, get_product, get_price, get_product_image, \
-    add_product_to_cart, get_cart_items, delete_cart_item, create_customer_address, \
-    get_customer_address, get_entries
+from moltin import configure_client, configure_token_manager, get_client, get_moltin_token, get_products, \
+    get_product_card, get_stocks, create_customer_address, \
+    get_customer_address
+from state_router import AppContext, StateRouter
+from state_store import StateStore
+from photo_cache import ProductPhotoCache
+from reminders import ReminderScheduler
+from rendering import get_menu_keyboard, render_cart, render_order
+from sharding import ShardWorker, UpdateStreamPublisher
+from webhook_server import ChatSerialExecutor, WebhookServer, get_update_chat_id
 from payment_tools import precheckout_callback, successful_payment_callback, start_without_shipping_callback
 
 logger = logging.getLogger('shop_tg_bot')
+network_logger = logging.getLogger('shop_tg_bot_network')
+
+CUSTOMER_ADDRESS_TTL = 7 * 86400
+CUSTOMER_REMINDER_DELAY = 3600
 
 _database = None
+_catalog_cache = None
+_stock_table = None
+_state_store = None
+_photo_cache = None
 
 
-def send_customer_reminder(bot, job):
+def send_customer_reminder(bot, chat_id):
     text = textwrap.dedent(f'''
     Приятного аппетита! 
     Если пицца до сих пор не была доставлена, пожалуйста напишите нам на электропочту намоченьстыдно@пицца.ру.
     Спасибо, что выбрали нас!
     ''')
-    bot.send_message(job.context, text=text)
+    bot.send_message(chat_id, text=text)
 
 
 def error_handler(bot, update, error):
-    logger.error(f'Телеграм бот упал с ошибкой: {error}', exc_info=True)
-
+    if isinstance(error, telegram.error.NetworkError):
+        network_logger.info(f'Телеграм временно недоступен: {error}')
+        return
 
-def start(bot,
-          update,
-          client_id,
-          client_secret,
-          yandex_api_token,
-          job_queue,
-          payment_token,
-          payload_word
-          ):
-    moltin_token = get_moltin_token(client_id, client_secret)
-    products = get_products(moltin_token)
+    logger.error(f'Телеграм бот упал с ошибкой: {error}', exc_info=True)
 
-    keyboard = [[InlineKeyboardButton(
-        product['attributes']['name'],
-        callback_data=product['id']
-    )] for product in products]
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
+def start(bot, update, app):
+    products, catalog_version = get_catalog_cache(app.client_id, app.client_secret).get_catalog()
+    sold_out_ids = get_stock_table(app.client_id, app.client_secret).get_sold_out_ids()
+    reply_markup = get_menu_keyboard(
+        products, catalog_version, with_cart_button=False, sold_out_ids=sold_out_ids
+    )
 
     update.message.reply_text(
         f'Доброго денечка, {update.message.chat.username} ! \n Не желаете пиццы?',
@@ -64,21 +78,20 @@ def start(bot,
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_waiting(
-        bot,
-        update,
-        client_id,
-        client_secret,
-        yandex_api_token,
-        job_queue,
-        payment_token,
-        payload_word
-):
-    moltin_token = get_moltin_token(client_id, client_secret)
+def handle_waiting(bot, update, app):
+    moltin_token = get_moltin_token(app.client_id, app.client_secret)
 
     if update.message.text:
         try:
-            lon, lat = fetch_coordinates(yandex_api_token, update.message.text)
+            lon, lat = fetch_coordinates(app.yandex_api_token, update.message.text)
+        except (CircuitOpenError, requests.RequestException):
+            location_keyboard = [[KeyboardButton('Отправить геолокацию', request_location=True)]]
+            bot.send_message(
+                chat_id=update.message.chat_id,
+                text='Сейчас не получается найти адрес по тексту. Пришлите, пожалуйста, геолокацию.',
+                reply_markup=ReplyKeyboardMarkup(location_keyboard, resize_keyboard=True, one_time_keyboard=True)
+            )
+            return 'WAITING_PAYMENT'
         except Exception:
             bot.send_message(
                 chat_id=update.message.chat_id,
@@ -97,21 +110,19 @@ def handle_waiting(
 
     nearest_pizzeria = get_nearest_pizzeria(lon, lat, moltin_token)
     distance = nearest_pizzeria['distance']
+    shipping_cost = get_delivery_cost(distance)
 
-    if 20 >= int(distance) > 5:
+    if shipping_cost == 300:
         text = f'До ближайшей пиццерии {distance} км. от Вас, доставка будет стоить 300 руб. Везем?'
-        shipping_cost = 300
-    elif 5 >= int(distance) > 0.5:
+    elif shipping_cost == 100:
         text = f'Похоже придется ехать до Вас на самокате. Доставка будет стоить 100 руб. Доставляем или самовывоз?'
-        shipping_cost = 100
-    elif int(distance) <= 0.5:
+    elif shipping_cost == 0:
         meters_distance = distance * 1000
         text = f'''
         Может, заберете пиццу из нашей пиццерии неподалеку? Она всего в {meters_distance} метрах
         от Вас! Вот ее адрес: {nearest_pizzeria["Address"]}. А можем и бесплатно доставить, нам
         несложно!
         '''
-        shipping_cost = 0
     else:
         text = f'''К сожалению, Вы находитесь вне зоны нашей доставки.
                    Ближайшая пиццерия находится на расстоянии
@@ -121,20 +132,12 @@ def handle_waiting(
             chat_id=update.message.chat_id,
             text=text
         )
-        handle_menu(
-            bot,
-            update,
-            client_id,
-            client_secret,
-            yandex_api_token,
-            job_queue,
-            payment_token,
-            payload_word
-        )
+        handle_menu(bot, update, app)
 
         return 'HANDLE_DESCRIPTION'
 
-    create_customer_address(moltin_token, 'customer_address', lon, lat, update.message.chat_id)
+    address_id = create_customer_address(moltin_token, 'customer_address', lon, lat, update.message.chat_id)
+    save_customer_address(update.message.chat_id, address_id, lon, lat)
 
     keyboard = [
         [InlineKeyboardButton('Самовывоз', callback_data='Самовывоз')],
@@ -151,41 +154,28 @@ def handle_waiting(
     return 'WAITING_DELIVERY'
 
 
-def handle_delivery(bot, update, client_id, client_secret, yandex_api_token, job_queue, payment_token, payload_word):
+def handle_delivery(bot, update, app):
     query = update.callback_query
-    moltin_token = get_moltin_token(client_id, client_secret)
+    moltin_token = get_moltin_token(app.client_id, app.client_secret)
     chat_id = query.message.chat.id
 
     if 'Доставка' in query.data:
-        lon, lat = None, None
-        customers_coordinates = get_entries(moltin_token, 'customer_address')
+        customer_address = load_customer_address(chat_id, moltin_token)
+        if customer_address is None:
+            bot.send_message(
+                chat_id=chat_id,
+                text='Укажите, пожалуйста, Ваш адрес (пришлите геолокацию, или напишите текстом)'
+            )
+            return 'WAITING_PAYMENT'
 
-        for customer_coordinates in customers_coordinates:
-            if customer_coordinates['customer_telegram_id'] == str(chat_id):
-                lon, lat = customer_coordinates['lon'], customer_coordinates['lat']
-                break
+        lon, lat = customer_address['lon'], customer_address['lat']
         delivaryman_tg_chat_id = get_nearest_pizzeria(lon, lat, moltin_token)['deliveryman_telegram_id']
         bot.send_location(chat_id=int(delivaryman_tg_chat_id), latitude=lat, longitude=lon)
-        job_queue.run_once(send_customer_reminder, 3600, context=query.message.chat_id)
+        app.reminders.schedule(query.message.chat_id, CUSTOMER_REMINDER_DELAY)
 
-        total_amount = 0
-        cart, products_sum = get_cart_items(moltin_token, chat_id)
+        cart = app.carts.reconcile(chat_id)
         _, shipping_cost = query.data.split()
-        cart_list = 'Ваш заказ:\n'
-        if cart:
-            for item in cart:
-                product_price = item['unit_price']['amount']
-                cart_list += f'''
-                         {item["name"]}
-                         {item["description"]}
-                         Цена: {product_price} Руб.
-                         {item["quantity"]} шт. в корзине - {item["value"]["amount"]} Руб.
-                         __________________________________________________________
-                         '''
-            cart_list = "\n".join([line.lstrip() for line in cart_list.split("\n")])
-            cart_list += f'\nДоставка: {shipping_cost} Руб.\n'
-            total_amount = products_sum + int(shipping_cost)
-            cart_list += f'\nК оплате: {total_amount} Руб.'
+        cart_list, total_amount = render_order(cart, shipping_cost)
 
         keyboard = [
             [InlineKeyboardButton('Оплата', callback_data=f'расплата {total_amount}')],
@@ -211,26 +201,20 @@ def handle_delivery(bot, update, client_id, client_secret, yandex_api_token, job
         return 'HANDLE_DESCRIPTION'
 
 
-def handle_payment(bot, update, client_id, client_secret, yandex_api_token, job_queue, payment_token, payload_word):
+def handle_payment(bot, update, app):
     query = update.callback_query
 
     if 'расплата' in query.data:
         _, total_amount = query.data.split()
-        start_without_shipping_callback(bot, update, int(total_amount), payment_token, payload_word)
+        start_without_shipping_callback(bot, update, int(total_amount), app.payment_token, app.payload_word)
 
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_menu(bot, update, client_id, client_secret, yandex_api_token, job_queue, payment_token, payload_word):
-    moltin_token = get_moltin_token(client_id, client_secret)
-    products = get_products(moltin_token)
-
-    keyboard = [[InlineKeyboardButton(
-        product['attributes']['name'],
-        callback_data=product['id']
-    )] for product in products]
-    keyboard.append([InlineKeyboardButton('Корзина', callback_data='Корзина')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+def handle_menu(bot, update, app):
+    products, catalog_version = get_catalog_cache(app.client_id, app.client_secret).get_catalog()
+    sold_out_ids = get_stock_table(app.client_id, app.client_secret).get_sold_out_ids()
+    reply_markup = get_menu_keyboard(products, catalog_version, sold_out_ids=sold_out_ids)
 
     update.callback_query.message.reply_text(
         'Товары магазина:',
@@ -243,98 +227,93 @@ def handle_menu(bot, update, client_id, client_secret, yandex_api_token, job_que
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(bot, update, client_id, client_secret, yandex_api_token, job_queue, payment_token, payload_word):
+def handle_description(bot, update, app):
     query = update.callback_query
-    moltin_token = get_moltin_token(client_id, client_secret)
+    moltin_token = get_moltin_token(app.client_id, app.client_secret)
     chat_id = query.message.chat.id
 
     if 'Положить' in query.data:
         _, product_id = query.data.split()
-        add_product_to_cart(moltin_token, product_id, 1, chat_id)
+        if not get_stock_table(app.client_id, app.client_secret).is_in_stock(product_id):
+            bot.answer_callback_query(query.id, text='Этой пиццы сейчас нет в наличии')
+
+            return 'HANDLE_DESCRIPTION'
+
+        app.carts.add(chat_id, get_product_card(moltin_token, product_id), 1)
 
         return 'HANDLE_DESCRIPTION'
 
     if query.data == 'Назад':
-        handle_menu(
-            bot,
-            update,
-            client_id,
-            client_secret,
-            yandex_api_token,
-            job_queue,
-            payment_token,
-            payload_word
-        )
+        handle_menu(bot, update, app)
 
         return 'HANDLE_DESCRIPTION'
 
     if query.data == 'Корзина':
-        handle_cart(
-            bot,
-            update,
-            client_id,
-            client_secret,
-            yandex_api_token,
-            job_queue,
-            payment_token,
-            payload_word
-        )
+        handle_cart(bot, update, app)
 
         return 'HANDLE_CART'
 
     else:
         product_id = query.data
-        moltin_token = get_moltin_token(client_id, client_secret)
+        moltin_token = get_moltin_token(app.client_id, app.client_secret)
 
-        product = get_product(moltin_token, product_id)
-        price = get_price(moltin_token, product_id)
-        image_link = get_product_image(moltin_token, product_id)
+        product_card = get_product_card(moltin_token, product_id)
+        is_in_stock = get_stock_table(app.client_id, app.client_secret).is_in_stock(product_id)
 
         keyboard = [
-            [InlineKeyboardButton('Положить в корзину', callback_data=f'Положить {product_id}')],
             [InlineKeyboardButton('Назад', callback_data='Назад')],
             [InlineKeyboardButton('Корзина', callback_data='Корзина')],
         ]
+        if is_in_stock:
+            keyboard.insert(0, [InlineKeyboardButton('Положить в корзину', callback_data=f'Положить {product_id}')])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         text = (
-            f'{product["attributes"]["name"]}\n'
-            f'{price["RUB"]["amount"]} руб.\n'
-            f'{product["attributes"]["description"]}'
+            f'{product_card["name"]}\n'
+            f'{product_card["price"]["RUB"]["amount"]} руб.\n'
+            f'{product_card["description"]}'
         )
+        if not is_in_stock:
+            text += '\n\nНет в наличии'
 
-        bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=image_link,
-            caption=textwrap.dedent(text),
-            reply_markup=reply_markup,
-        )
+        send_product_photo(bot, query.message.chat_id, product_card, textwrap.dedent(text), reply_markup)
         bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.message_id)
 
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_cart(bot, update, client_id, client_secret, yandex_api_token, job_queue, payment_token, payload_word):
+def send_product_photo(bot, chat_id, product_card, caption, reply_markup):
+    photo_cache = get_photo_cache()
+    file_id = photo_cache.get_file_id(product_card['id'], product_card['image_id'])
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
+        except telegram.error.BadRequest:
+            photo_cache.invalidate(product_card['id'])
+
+    message = bot.send_photo(
+        chat_id=chat_id,
+        photo=product_card['image_link'],
+        caption=caption,
+        reply_markup=reply_markup,
+    )
+    if message.photo:
+        photo_cache.save_file_id(product_card['id'], product_card['image_id'], message.photo[-1].file_id)
+
+    return message
+
+
+def handle_cart(bot, update, app):
     query = update.callback_query
-    moltin_token = get_moltin_token(client_id, client_secret)
     chat_id = query.message.chat.id
 
     if 'Убрать' in query.data:
         _, product_id = query.data.split()
-        delete_cart_item(moltin_token, chat_id, product_id)
+        app.carts.remove(chat_id, product_id)
 
     if query.data == 'В меню':
-        handle_menu(
-            bot,
-            update,
-            client_id,
-            client_secret,
-            yandex_api_token,
-            job_queue,
-            payment_token,
-            payload_word
-        )
+        handle_menu(bot, update, app)
 
         return 'HANDLE_DESCRIPTION'
 
@@ -345,30 +324,8 @@ def handle_cart(bot, update, client_id, client_secret, yandex_api_token, job_que
         )
         return 'WAITING_PAYMENT'
 
-    cart, products_sum = get_cart_items(moltin_token, chat_id)
-
-    cart_list = ''
-    keyboard = []
-    if cart:
-        for item in cart:
-            product_price = item['unit_price']['amount']
-            cart_list += f'''
-                         {item["name"]}
-                         {item["description"]}
-                         Цена: {product_price} Руб.
-                         {item["quantity"]} шт. в корзине - {item["value"]["amount"]} Руб.
-                         __________________________________________________________
-                         '''
-            keyboard.append([InlineKeyboardButton(f'Убрать из корзины {item["name"]}',
-                                                  callback_data=f'Убрать {item["id"]}')])
-        cart_list = "\n".join([line.lstrip() for line in cart_list.split("\n")])
-        cart_list += f'\nИтого: {products_sum} Руб.'
-        keyboard.append([InlineKeyboardButton('Оплатить', callback_data='Оплатить')])
-    else:
-        cart_list = 'Пожалуйста, перейдите в меню и выберите товар.'
-
-    keyboard.append([InlineKeyboardButton('В меню', callback_data='В меню')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    cart = app.carts.get_or_reconcile_cart(chat_id)
+    cart_list, reply_markup = render_cart(cart)
     bot.send_message(chat_id=query.message.chat_id, text=cart_list, reply_markup=reply_markup)
     bot.delete_message(chat_id=update.callback_query.message.chat.id,
                        message_id=update.callback_query.message.message_id)
@@ -376,17 +333,8 @@ def handle_cart(bot, update, client_id, client_secret, yandex_api_token, job_que
     return 'HANDLE_CART'
 
 
-def handle_users_reply(
-        bot,
-        update,
-        client_id,
-        client_secret,
-        yandex_api_token,
-        job_queue,
-        payment_token,
-        payload_word
-):
-    db = get_database_connection()
+def handle_users_reply(bot, update, router):
+    state_store = get_state_store()
 
     if update.message:
         user_reply = update.message.text
@@ -398,85 +346,39 @@ def handle_users_reply(
         return
     if user_reply == '/start':
         user_state = 'START'
-    elif not db.get(chat_id):
+    else:
+        user_state = state_store.get_state(chat_id)
+
+    if user_state is None:
         bot.send_message(
-            chat_id=update.message.chat_id,
+            chat_id=chat_id,
             text='Кажется Вы у нас впервые, запустите бота командой "/start"'
         )
         return
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
-
-    states_functions = {
-        'START': partial(
-            start,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'HANDLE_MENU': partial(
-            handle_menu,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'HANDLE_DESCRIPTION': partial(
-            handle_description,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'HANDLE_CART': partial(
-            handle_cart,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'WAITING_PAYMENT': partial(
-            handle_waiting,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'WAITING_DELIVERY': partial(
-            handle_delivery,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
-        'WAITING_TRANSACTION': partial(
-            handle_payment,
-            client_id=client_id,
-            client_secret=client_secret,
-            yandex_api_token=yandex_api_token,
-            job_queue=job_queue,
-            payment_token=payment_token,
-            payload_word=payload_word
-        ),
 
-    }
-    state_handler = states_functions[user_state]
+    try:
+        next_state = router.dispatch(user_state, bot, update)
+    except CircuitOpenError as error:
+        network_logger.info(f'Ответ пользователю отложен: {error}')
+        bot.send_message(
+            chat_id=chat_id,
+            text='Магазин сейчас не отвечает, попробуйте, пожалуйста, через минуту.'
+        )
+        return
+    state_store.set_state(chat_id, next_state)
+
 
-    next_state = state_handler(bot, update)
-    db.set(chat_id, next_state)
+def build_router(app):
+    router = StateRouter(app)
+    router.register('START', start)
+    router.register('HANDLE_MENU', handle_menu)
+    router.register('HANDLE_DESCRIPTION', handle_description)
+    router.register('HANDLE_CART', handle_cart)
+    router.register('WAITING_PAYMENT', handle_waiting)
+    router.register('WAITING_DELIVERY', handle_delivery)
+    router.register('WAITING_TRANSACTION', handle_payment)
+
+    return router
 
 
 def get_database_connection():
@@ -490,6 +392,162 @@ def get_database_connection():
     return _database
 
 
+def get_state_store():
+    global _state_store
+
+    if _state_store is None:
+        _state_store = StateStore(
+            get_database_connection(),
+            ttl=int(os.getenv('STATE_TTL', 30 * 86400)),
+            cache_size=int(os.getenv('STATE_CACHE_SIZE', 0)),
+        )
+
+    return _state_store
+
+
+def get_photo_cache():
+    global _photo_cache
+
+    if _photo_cache is None:
+        _photo_cache = ProductPhotoCache(get_database_connection())
+
+    return _photo_cache
+
+
+def save_customer_address(chat_id, address_id, lon, lat):
+    db = get_database_connection()
+    address_key = f'shop_bot:customer_address:{chat_id}'
+    pipeline = db.pipeline()
+    pipeline.hset(address_key, mapping={'id': address_id, 'lon': lon, 'lat': lat})
+    pipeline.expire(address_key, CUSTOMER_ADDRESS_TTL)
+    pipeline.execute()
+
+
+def load_customer_address(chat_id, moltin_token):
+    db = get_database_connection()
+    customer_address = {
+        key.decode('utf-8'): value.decode('utf-8')
+        for key, value in db.hgetall(f'shop_bot:customer_address:{chat_id}').items()
+    }
+    if not customer_address:
+        return None
+
+    if 'lon' not in customer_address or 'lat' not in customer_address:
+        address_entry = get_customer_address(moltin_token, 'customer_address', customer_address['id'])
+        customer_address['lon'], customer_address['lat'] = address_entry['lon'], address_entry['lat']
+        save_customer_address(chat_id, customer_address['id'], customer_address['lon'], customer_address['lat'])
+
+    return customer_address
+
+
+def get_catalog_cache(client_id, client_secret):
+    global _catalog_cache
+
+    if _catalog_cache is None:
+        _catalog_cache = ProductCatalogCache(
+            lambda: get_products(get_moltin_token(client_id, client_secret)),
+            ttl=int(os.getenv('CATALOG_CACHE_TTL', 300)),
+            redis_db=get_database_connection(),
+        )
+
+    return _catalog_cache
+
+
+def get_stock_table(client_id, client_secret):
+    global _stock_table
+
+    if _stock_table is None:
+        _stock_table = StockTable(
+            lambda: get_stocks(get_moltin_token(client_id, client_secret)),
+            ttl=int(os.getenv('STOCK_CACHE_TTL', 30)),
+        )
+
+    return _stock_table
+
+
+def build_update_processor(updater):
+    def process_update(update_json):
+        updater.dispatcher.process_update(telegram.Update.de_json(update_json, updater.bot))
+
+    return process_update
+
+
+def serve_webhook(updater, server):
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        response = requests.post(
+            f'https://api.telegram.org/bot{updater.bot.token}/setWebhook',
+            json={'url': webhook_url, 'secret_token': server.secret_token},
+            timeout=10,
+        )
+        response.raise_for_status()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+def run_webhook(updater):
+    executor = ChatSerialExecutor(
+        build_update_processor(updater),
+        workers=int(os.getenv('WEBHOOK_WORKERS', 8)),
+        backlog=int(os.getenv('WEBHOOK_BACKLOG', 1000)),
+    )
+    server = WebhookServer(
+        lambda update_json: executor.submit(get_update_chat_id(update_json), update_json),
+        executor.get_stats,
+        os.getenv('WEBHOOK_SECRET'),
+        port=int(os.getenv('WEBHOOK_PORT', 8443)),
+        path=os.getenv('WEBHOOK_PATH', '/webhook'),
+    )
+    serve_webhook(updater, server)
+    executor.stop()
+    logging.info(f'Webhook stats: {executor.get_stats()}')
+
+
+def run_ingest(updater):
+    publisher = UpdateStreamPublisher(get_database_connection(), int(os.getenv('SHARD_COUNT', 1)))
+    server = WebhookServer(
+        publisher.publish,
+        publisher.get_stats,
+        os.getenv('WEBHOOK_SECRET'),
+        port=int(os.getenv('WEBHOOK_PORT', 8443)),
+        path=os.getenv('WEBHOOK_PATH', '/webhook'),
+    )
+    serve_webhook(updater, server)
+    logging.info(f'Ingest stats: {publisher.get_stats()}')
+
+
+def run_shard_workers(updater):
+    process_update = build_update_processor(updater)
+    shard_count = int(os.getenv('SHARD_COUNT', 1))
+    if os.getenv('SHARD_INDEXES'):
+        shard_indexes = [int(shard) for shard in os.getenv('SHARD_INDEXES').split(',')]
+    else:
+        worker_index = int(os.getenv('WORKER_INDEX', 0))
+        worker_count = int(os.getenv('WORKER_COUNT', 1))
+        shard_indexes = [shard for shard in range(shard_count) if shard % worker_count == worker_index]
+    if not shard_indexes:
+        raise ValueError(f'Воркеру не досталось ни одного шарда из {shard_count}, проверьте WORKER_INDEX и WORKER_COUNT')
+    shard_workers = [ShardWorker(get_database_connection(), shard, process_update) for shard in shard_indexes]
+    threads = [threading.Thread(target=shard_worker.run, daemon=True) for shard_worker in shard_workers]
+
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for shard_worker in shard_workers:
+            shard_worker.stop()
+    logging.info(f'Shard worker stats: {[shard_worker.stats for shard_worker in shard_workers]}')
+
+
 if __name__ == '__main__':
     load_dotenv()
     telegram_api_token = os.getenv('TELEGRAM_API_TOKEN')
@@ -508,67 +566,73 @@ if __name__ == '__main__':
     logger.setLevel(logging.WARNING)
     logger.addHandler(TelegramLogsHandler(logger_bot, telegram_admin_chat_id))
 
-    updater = Updater(telegram_api_token)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(
-        MessageHandler(
-            Filters.location,
-            partial(
-                handle_users_reply,
-                client_id=client_id,
-                client_secret=client_secret,
-                yandex_api_token=yandex_api_token,
-                payment_token=payment_token,
-                payload_word=payload_word
-            ),
-            pass_job_queue=True
-        )
+    configure_client(
+        pool_maxsize=int(os.getenv('MOLTIN_POOL_SIZE', 16)),
+        retries=int(os.getenv('MOLTIN_RETRIES', 3)),
+        timeout=float(os.getenv('MOLTIN_TIMEOUT', 10)),
     )
-    dispatcher.add_handler(
-        CallbackQueryHandler(
-            partial(
-                handle_users_reply,
-                client_id=client_id,
-                client_secret=client_secret,
-                yandex_api_token=yandex_api_token,
-                payment_token=payment_token,
-                payload_word=payload_word
-            ),
-            pass_job_queue=True
-        )
+    configure_circuit_breakers(
+        open_seconds=float(os.getenv('CIRCUIT_OPEN_SECONDS', 30)),
+        slow_call_seconds=float(os.getenv('CIRCUIT_SLOW_CALL_SECONDS', 5)),
     )
-    dispatcher.add_handler(
-        MessageHandler(
-            Filters.text,
-            partial(
-                handle_users_reply,
-                client_id=client_id,
-                client_secret=client_secret,
-                yandex_api_token=yandex_api_token,
-                payment_token=payment_token,
-                payload_word=payload_word
-            ),
-            pass_job_queue=True
-        )
+    configure_token_manager(redis_db=get_database_connection())
+    geocode_cache = configure_geocode_cache(
+        ttl=int(os.getenv('GEOCODE_CACHE_TTL', 30 * 86400)),
+        max_entries=int(os.getenv('GEOCODE_CACHE_SIZE', 10000)),
+        redis_db=get_database_connection(),
     )
-    dispatcher.add_handler(
-        CommandHandler(
-            'start',
-            partial(
-                handle_users_reply,
-                client_id=client_id,
-                client_secret=client_secret,
-                yandex_api_token=yandex_api_token,
-                payment_token=payment_token,
-                payload_word=payload_word
-            ),
-            pass_job_queue=True
-        )
+    configure_geocoder_rate_limit(float(os.getenv('GEOCODE_RATE_LIMIT', 0)))
+
+    updater = Updater(telegram_api_token)
+    carts = LocalCartStore(
+        get_database_connection(),
+        partial(get_moltin_token, client_id, client_secret),
+        sync_interval=float(os.getenv('CART_SYNC_INTERVAL', 2)),
+    )
+    reminders = ReminderScheduler(
+        get_database_connection(),
+        partial(send_customer_reminder, updater.bot),
+        batch_size=int(os.getenv('REMINDERS_BATCH_SIZE', 100)),
+    )
+    app = AppContext(
+        client_id=client_id,
+        client_secret=client_secret,
+        yandex_api_token=yandex_api_token,
+        reminders=reminders,
+        carts=carts,
+        payment_token=payment_token,
+        payload_word=payload_word,
     )
+    router = build_router(app)
+    users_reply_handler = partial(handle_users_reply, router=router)
+
+    dispatcher = updater.dispatcher
+    dispatcher.add_handler(MessageHandler(Filters.location, users_reply_handler))
+    dispatcher.add_handler(CallbackQueryHandler(users_reply_handler))
+    dispatcher.add_handler(MessageHandler(Filters.text, users_reply_handler))
+    dispatcher.add_handler(CommandHandler('start', users_reply_handler))
 
     dispatcher.add_handler(PreCheckoutQueryHandler(partial(precheckout_callback, payload_word=payload_word)))
     dispatcher.add_handler(MessageHandler(Filters.successful_payment, successful_payment_callback))
     dispatcher.add_error_handler(error_handler)
-    updater.start_polling()
 
-    updater.idle()
+    bot_mode = os.getenv('BOT_MODE', 'polling')
+    if bot_mode != 'ingest':
+        reminders.start()
+        carts.start()
+
+    if bot_mode == 'webhook':
+        run_webhook(updater)
+    elif bot_mode == 'ingest':
+        run_ingest(updater)
+    elif bot_mode == 'worker':
+        run_shard_workers(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    logging.info(f'Moltin connection pool stats: {get_client().get_stats()}')
+    logging.info(f'Circuit breaker stats: {get_circuit_breakers_stats()}')
+    logging.info(f'Geocode cache stats: {geocode_cache.get_stats()}')
+    logging.info(f'Conversation state stats: {router.get_stats()}')
+    logging.info(f'Reminder stats: {reminders.get_stats()}')
+    logging.info(f'Cart sync stats: {carts.stats}')
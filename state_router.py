@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import namedtuple
+
+AppContext = namedtuple(
+    'AppContext',
+    ['client_id', 'client_secret', 'yandex_api_token', 'reminders', 'carts', 'payment_token', 'payload_word'],
+)
+
+
+class StateRouter:
+
+    def __init__(self, app):
+        self.app = app
+        self.handlers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, state, handler):
+        self.handlers[state] = handler
+        self._stats[state] = {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+
+    def dispatch(self, state, bot, update):
+        handler = self.handlers[state]
+        started_at = time.perf_counter()
+        failed = True
+        try:
+            next_state = handler(bot, update, self.app)
+            failed = False
+            return next_state
+        finally:
+            elapsed = time.perf_counter() - started_at
+            with self._lock:
+                state_stats = self._stats[state]
+                state_stats['calls'] += 1
+                state_stats['errors'] += failed
+                state_stats['total_seconds'] += elapsed
+                state_stats['max_seconds'] = max(state_stats['max_seconds'], elapsed)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                state: {
+                    'calls': state_stats['calls'],
+                    'errors': state_stats['errors'],
+                    'avg_ms': state_stats['total_seconds'] * 1000 / state_stats['calls'] if state_stats['calls'] else 0,
+                    'max_ms': state_stats['max_seconds'] * 1000,
+                }
+                for state, state_stats in self._stats.items()
+            }
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class StateStore:
+
+    def __init__(self, backend, namespace='shop_bot:state', ttl=30 * 86400, cache_size=0, legacy_keys=True):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.legacy_keys = legacy_keys
+        self._cache = OrderedDict()
+        self._legacy_chat_ids = set()
+        self._lock = threading.Lock()
+
+    def get_state(self, chat_id):
+        if self.cache_size:
+            with self._lock:
+                state = self._cache.get(chat_id)
+                if state is not None:
+                    self._cache.move_to_end(chat_id)
+                    return state
+
+        if self.legacy_keys:
+            pipeline = self.backend.pipeline()
+            pipeline.get(self._get_key(chat_id))
+            pipeline.get(chat_id)
+            state, legacy_state = pipeline.execute()
+            if state is None and legacy_state is not None:
+                state = legacy_state
+                with self._lock:
+                    self._legacy_chat_ids.add(chat_id)
+        else:
+            state = self.backend.get(self._get_key(chat_id))
+
+        if state is None:
+            return None
+        state = state.decode('utf-8') if isinstance(state, bytes) else state
+        self._remember(chat_id, state)
+
+        return state
+
+    def set_state(self, chat_id, state):
+        with self._lock:
+            is_legacy = chat_id in self._legacy_chat_ids
+            self._legacy_chat_ids.discard(chat_id)
+
+        if is_legacy:
+            pipeline = self.backend.pipeline()
+            pipeline.set(self._get_key(chat_id), state, ex=self.ttl)
+            pipeline.delete(chat_id)
+            pipeline.execute()
+        else:
+            self.backend.set(self._get_key(chat_id), state, ex=self.ttl)
+        self._remember(chat_id, state)
+
+    def delete_state(self, chat_id):
+        self.backend.delete(self._get_key(chat_id))
+        with self._lock:
+            self._cache.pop(chat_id, None)
+
+    def _get_key(self, chat_id):
+        return f'{self.namespace}:{chat_id}'
+
+    def _remember(self, chat_id, state):
+        if not self.cache_size:
+            return
+
+        with self._lock:
+            self._cache[chat_id] = state
+            self._cache.move_to_end(chat_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+class InMemoryBackend:
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._values.get(str(key), (None, None))
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._values[str(key)]
+                return None
+
+            return value
+
+    def set(self, key, value, ex=None):
+        expires_at = time.monotonic() + ex if ex else None
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        with self._lock:
+            self._values[str(key)] = (value, expires_at)
+
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._values.pop(str(key), None) is not None for key in keys)
+
+    def pipeline(self):
+        return InMemoryPipeline(self)
+
+
+class InMemoryPipeline:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._commands = []
+
+    def get(self, key):
+        self._commands.append((self.backend.get, (key,), {}))
+
+    def set(self, key, value, ex=None):
+        self._commands.append((self.backend.set, (key, value), {'ex': ex}))
+
+    def delete(self, *keys):
+        self._commands.append((self.backend.delete, keys, {}))
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
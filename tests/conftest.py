@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def redis_db():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    import moltin
+
+    servers = []
+
+    def start(handle):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self._respond()
+
+            def do_POST(self):
+                self._respond()
+
+            def do_PUT(self):
+                self._respond()
+
+            def do_DELETE(self):
+                self._respond()
+
+            def _respond(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                url = urlsplit(self.path)
+                status, payload = handle(self.command, url.path, dict(parse_qsl(url.query)), self.headers, body)
+                content = json.dumps(payload).encode() if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setattr(moltin, 'API_URL', f'http://127.0.0.1:{server.server_port}')
+        monkeypatch.setattr(moltin, '_client', None)
+
+        return moltin.API_URL
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+import pytest
+import requests
+
+import moltin
+from circuit_breaker import CircuitOpenError, configure_circuit_breakers
+
+pytest.importorskip('aiohttp')
+
+from async_moltin import AsyncMoltinClient  # noqa: E402
+
+
+def run_with_client(coroutine_function, **client_options):
+    async def run():
+        async with AsyncMoltinClient(backoff_factor=0, **client_options) as client:
+            return await coroutine_function(client)
+
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def fresh_circuit_breakers():
+    configure_circuit_breakers()
+    yield
+    configure_circuit_breakers()
+
+
+def test_http_error_carries_status_and_body(stub_api):
+    api_url = stub_api(lambda method, path, params, headers, body: (404, {'errors': [{'detail': 'no such cart'}]}))
+
+    with pytest.raises(requests.HTTPError) as error_info:
+        run_with_client(lambda client: client.request('GET', f'{api_url}/v2/carts/42'))
+
+    assert error_info.value.response.status_code == 404
+    assert error_info.value.response.json() == {'errors': [{'detail': 'no such cart'}]}
+
+
+def test_server_errors_are_retried_for_idempotent_requests_only(stub_api):
+    requested_methods = []
+
+    def handle(method, path, params, headers, body):
+        requested_methods.append(method)
+        if len(requested_methods) < 3:
+            return 503, {'errors': []}
+        return 200, {'data': []}
+
+    api_url = stub_api(handle)
+
+    assert run_with_client(lambda client: client.request('GET', f'{api_url}/v2/carts/42')) == {'data': []}
+    assert requested_methods == ['GET'] * 3
+
+    requested_methods.clear()
+    with pytest.raises(requests.HTTPError):
+        run_with_client(lambda client: client.request('POST', f'{api_url}/v2/carts/42/items', json={}))
+    assert requested_methods == ['POST']
+
+
+def test_rejected_token_is_refreshed_and_request_retried(stub_api, monkeypatch):
+    monkeypatch.setattr(moltin, '_token_managers', {})
+    token_manager = moltin.get_token_manager('client-key', 'secret-key')
+    issued_tokens = []
+
+    def request_token():
+        issued_tokens.append(f'token-{len(issued_tokens) + 1}')
+        return issued_tokens[-1], time.time() + 3600
+
+    monkeypatch.setattr(token_manager, '_request_token', request_token)
+    sent_tokens = []
+
+    def handle(method, path, params, headers, body):
+        sent_tokens.append(headers['Authorization'])
+        if headers['Authorization'] != 'Bearer token-2':
+            return 401, {'errors': []}
+        return 200, {'data': {'id': 'cart'}}
+
+    api_url = stub_api(handle)
+
+    async def get_cart(client):
+        token = await client.get_moltin_token('client-key', 'secret-key')
+        return await client.request('GET', f'{api_url}/v2/carts/42', headers={'Authorization': f'Bearer {token}'})
+
+    assert run_with_client(get_cart) == {'data': {'id': 'cart'}}
+    assert sent_tokens == ['Bearer token-1', 'Bearer token-2']
+    token_manager._timer.cancel()
+
+
+def test_open_circuit_rejects_requests(stub_api):
+    configure_circuit_breakers(min_calls=2, open_seconds=60)
+    requests_count = []
+
+    def handle(method, path, params, headers, body):
+        requests_count.append(1)
+        return 500, {'errors': []}
+
+    api_url = stub_api(handle)
+
+    async def request_three_times(client):
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                await client.request('GET', f'{api_url}/v2/carts/42')
+        with pytest.raises(CircuitOpenError):
+            await client.request('GET', f'{api_url}/v2/carts/42')
+
+    run_with_client(request_three_times, retries=0)
+    assert len(requests_count) == 2
+
+
+async def collect_pages(client, url, **kwargs):
+    return [page async for page in client.iter_pages(url, {}, **kwargs)]
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_without_links_stop_on_short_page(stub_api, prefetch):
+    entries = list(range(5))
+    requested_offsets = []
+
+    def handle(method, path, params, headers, body):
+        offset, limit = int(params['page[offset]']), int(params['page[limit]'])
+        requested_offsets.append(offset)
+        return 200, {'data': entries[offset:offset + limit]}
+
+    api_url = stub_api(handle)
+
+    pages = run_with_client(lambda client: collect_pages(client, f'{api_url}/v2/flows', page_size=2, prefetch=prefetch))
+
+    assert pages == [[0, 1], [2, 3], [4]]
+    assert requested_offsets == [0, 2, 4]
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_follow_next_link_until_it_is_null_or_current(stub_api, prefetch):
+    requested_paths = []
+
+    def handle(method, path, params, headers, body):
+        requested_paths.append(path)
+        if path == '/v2/customers':
+            return 200, {'data': [1, 2], 'links': {'next': f'{api_url}/page-2'}}
+        if path == '/page-2':
+            return 200, {'data': [3, 4], 'links': {'current': f'{api_url}/page-2', 'next': f'{api_url}/page-2'}}
+        return 404, {'errors': []}
+
+    api_url = stub_api(handle)
+
+    pages = run_with_client(lambda client: collect_pages(
+        client, f'{api_url}/v2/customers', page_size=2, prefetch=prefetch
+    ))
+
+    assert pages == [[1, 2], [3, 4]]
+    assert requested_paths == ['/v2/customers', '/page-2']
@@ -0,0 +1,96 @@
+import pytest
+import requests
+
+import cart
+import moltin
+from cart import LocalCartStore
+
+
+def get_product_card(product_id):
+    return {'id': product_id, 'name': product_id, 'description': '', 'price': {'RUB': {'amount': 100}}}
+
+
+def get_http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+
+    return requests.HTTPError(f'{status_code} Error', response=response)
+
+
+@pytest.fixture
+def carts(redis_db):
+    return LocalCartStore(redis_db, lambda: 'token')
+
+
+def test_sync_requeues_unsent_additions_on_failure(carts, redis_db, monkeypatch):
+    sent_products = []
+
+    def add_product_to_cart(token, product_id, quantity, chat_id):
+        if product_id == 'B':
+            raise requests.ConnectionError('Moltin is down')
+        sent_products.append(product_id)
+
+    monkeypatch.setattr(cart, 'add_product_to_cart', add_product_to_cart)
+    for product_id in ('A', 'B', 'C'):
+        carts.add(42, get_product_card(product_id), 1)
+
+    with pytest.raises(requests.ConnectionError):
+        carts.sync(42)
+
+    pending = redis_db.hgetall('shop_bot:cart:42:pending')
+    assert {product_id.decode(): int(quantity) for product_id, quantity in pending.items()} == \
+        {product_id: 1 for product_id in ('A', 'B', 'C') if product_id not in sent_products}
+    assert redis_db.sismember(carts.dirty_key, 42)
+    assert carts.stats['failed_syncs'] == 1
+
+
+def test_sync_drops_rejected_addition_and_reloads_cart(carts, redis_db, monkeypatch):
+    def add_product_to_cart(token, product_id, quantity, chat_id):
+        if product_id == 'A':
+            raise get_http_error(400)
+
+    monkeypatch.setattr(cart, 'add_product_to_cart', add_product_to_cart)
+    redis_db.set('shop_bot:cart:42:synced', 1)
+    carts.add(42, get_product_card('A'), 1)
+    carts.add(42, get_product_card('B'), 1)
+
+    carts.sync(42)
+
+    assert redis_db.hgetall('shop_bot:cart:42:pending') == {}
+    assert carts.get_cart(42) is None
+    assert carts.stats['rejected_updates'] == 1
+    assert carts.stats['synced_updates'] == 1
+
+
+def test_sync_retries_server_errors(carts, redis_db, monkeypatch):
+    def add_product_to_cart(token, product_id, quantity, chat_id):
+        raise get_http_error(503)
+
+    monkeypatch.setattr(cart, 'add_product_to_cart', add_product_to_cart)
+    carts.add(42, get_product_card('A'), 2)
+
+    with pytest.raises(requests.HTTPError):
+        carts.sync(42)
+
+    assert redis_db.hgetall('shop_bot:cart:42:pending') == {b'A': b'2'}
+
+
+def test_remove_finds_item_synced_by_another_process(carts, monkeypatch):
+    cart_items = []
+    deleted_item_ids = []
+
+    def get_cart_items(token, chat_id):
+        return [dict(cart_item) for cart_item in cart_items], 100 * len(cart_items)
+
+    monkeypatch.setattr(cart, 'delete_cart_item', lambda token, chat_id, item_id: deleted_item_ids.append(item_id))
+    monkeypatch.setattr('moltin.get_cart_items', get_cart_items)
+    moltin.invalidate_cart_snapshot(42)
+    moltin.get_cart_snapshot('token', 42)
+    cart_items.append({
+        'id': 'item-1', 'product_id': 'A', 'name': 'A', 'description': '',
+        'unit_price': {'amount': 100}, 'quantity': 1, 'value': {'amount': 100},
+    })
+
+    carts.remove(42, 'A')
+
+    assert deleted_item_ids == ['item-1']
@@ -0,0 +1,64 @@
+import logging
+import time
+
+from catalog_cache import ProductCatalogCache
+
+
+def wait_for_background_refresh(catalog_cache):
+    for _ in range(100):
+        if not catalog_cache._refreshing:
+            return
+        time.sleep(0.01)
+
+
+def test_failing_refresh_is_retried_after_interval_and_logged_once(caplog):
+    fetches = []
+
+    def fetch_products():
+        fetches.append(1)
+        if len(fetches) > 1:
+            raise ConnectionError('moltin is down')
+        return [{'id': 'margherita'}]
+
+    catalog_cache = ProductCatalogCache(fetch_products, ttl=0, retry_interval=3600)
+    catalog_cache.get_products()
+    time.sleep(0.01)
+
+    with caplog.at_level(logging.WARNING, logger='shop_tg_bot'):
+        for _ in range(20):
+            assert catalog_cache.get_products() == [{'id': 'margherita'}]
+            wait_for_background_refresh(catalog_cache)
+
+    assert len(fetches) == 2
+    assert len(caplog.records) == 1
+
+
+def test_each_outage_is_logged_once(caplog):
+    outcomes = [None, ConnectionError('moltin is down'), ConnectionError('moltin is down'), None,
+                ConnectionError('moltin is down'), ConnectionError('moltin is down')]
+
+    def fetch_products():
+        outcome = outcomes.pop(0)
+        if outcome is not None:
+            raise outcome
+        return [{'id': 'margherita'}]
+
+    catalog_cache = ProductCatalogCache(fetch_products, ttl=0, retry_interval=0)
+    with caplog.at_level(logging.WARNING, logger='shop_tg_bot'):
+        while outcomes:
+            catalog_cache.refresh()
+
+    assert len(caplog.records) == 2
+
+
+def test_products_and_version_are_read_together():
+    catalogs = [[{'id': 'margherita'}], [{'id': 'margherita'}, {'id': 'pepperoni'}]]
+    catalog_cache = ProductCatalogCache(lambda: catalogs.pop(0), ttl=3600)
+
+    first_products, first_version = catalog_cache.get_catalog()
+    catalog_cache.refresh()
+    second_products, second_version = catalog_cache.get_catalog()
+
+    assert (first_products, second_products) == ([{'id': 'margherita'}], [{'id': 'margherita'}, {'id': 'pepperoni'}])
+    assert first_version != second_version
+    assert catalog_cache.version == second_version
@@ -0,0 +1,61 @@
+import threading
+import time
+
+from geolocation_tools import GeocodeCache
+
+
+def test_coordinates_are_shared_through_redis(redis_db):
+    GeocodeCache(redis_db=redis_db).set('Москва, Красная площадь, 1', ('37.62', '55.75'))
+
+    assert GeocodeCache(redis_db=redis_db).get('москва,  красная площадь, 1') == (True, ('37.62', '55.75'))
+
+
+def test_lru_updates_are_batched(redis_db):
+    geocode_cache = GeocodeCache(redis_db=redis_db, lru_batch_size=3, lru_flush_interval=3600)
+    for address in ('первый адрес', 'второй адрес', 'третий адрес'):
+        geocode_cache.set(address, ('37.62', '55.75'))
+    redis_db.delete('shop_bot:geocode:lru')
+
+    geocode_cache.get('первый адрес')
+    geocode_cache.get('второй адрес')
+    geocode_cache.get('первый адрес')
+    assert redis_db.zcard('shop_bot:geocode:lru') == 0
+
+    geocode_cache.get('третий адрес')
+    assert redis_db.zcard('shop_bot:geocode:lru') == 3
+
+
+def test_memory_hit_does_not_wait_for_redis_lookup(redis_db, monkeypatch):
+    geocode_cache = GeocodeCache(redis_db=redis_db)
+    geocode_cache.set('адрес', ('37.62', '55.75'))
+    redis_get = redis_db.get
+    lookup_started = threading.Event()
+
+    def slow_get(key):
+        lookup_started.set()
+        time.sleep(0.5)
+        return redis_get(key)
+
+    monkeypatch.setattr(redis_db, 'get', slow_get)
+    slow_lookup = threading.Thread(target=geocode_cache.get, args=('другой адрес',))
+    slow_lookup.start()
+    lookup_started.wait(timeout=1)
+
+    started_at = time.monotonic()
+    assert geocode_cache.get('адрес') == (True, ('37.62', '55.75'))
+    assert time.monotonic() - started_at < 0.25
+    slow_lookup.join()
+
+
+def test_shelf_evicts_least_recently_used_address(tmp_path):
+    geocode_cache = GeocodeCache(path=str(tmp_path / 'geocode_cache'), max_entries=3, lru_batch_size=1)
+    for address in ('первый адрес', 'второй адрес', 'третий адрес'):
+        geocode_cache.set(address, ('37.62', '55.75'))
+        time.sleep(0.01)
+    geocode_cache.get('первый адрес')
+    time.sleep(0.01)
+
+    geocode_cache.set('четвертый адрес', ('37.62', '55.75'))
+
+    assert sorted(geocode_cache.shelf.keys()) == sorted(['первый адрес', 'третий адрес', 'четвертый адрес'])
+    geocode_cache.close()
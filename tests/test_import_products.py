@@ -0,0 +1,89 @@
+import json
+import re
+import threading
+
+import pytest
+
+from import_products import ProductImporter
+
+
+class StubMoltin:
+
+    def __init__(self):
+        self.products = {}
+        self.uploads = []
+        self.failing_skus = set()
+        self.lock = threading.Lock()
+
+    def handle(self, method, path, body):
+        with self.lock:
+            if method == 'GET' and path == '/pcm/products':
+                return 200, {'data': list(self.products.values())}
+
+            if method == 'POST' and path == '/pcm/products':
+                attributes = json.loads(body)['data']['attributes']
+                product_id = f'product-{len(self.products) + 1}'
+                self.products[product_id] = {'id': product_id, 'attributes': attributes, 'relationships': {}}
+                return 201, {'data': {'id': product_id}}
+
+            if method == 'POST' and path == '/v2/files':
+                img_link, = re.findall(rb'name="file_location"\r\n\r\n(.*?)\r\n', body)
+                self.uploads.append(img_link.decode())
+                return 201, {'data': {'id': f'file-{len(self.uploads)}'}}
+
+            main_image = re.fullmatch(r'/pcm/products/(.+)/relationships/main_image', path)
+            if method == 'POST' and main_image:
+                product = self.products[main_image.group(1)]
+                if product['attributes']['sku'] in self.failing_skus:
+                    return 422, {'errors': [{'detail': 'main image rejected'}]}
+                product['relationships']['main_image'] = json.loads(body)
+                return 204, None
+
+        return 404, {'errors': [{'detail': f'{method} {path} is not stubbed'}]}
+
+
+@pytest.fixture
+def stub_moltin(stub_api):
+    stub = StubMoltin()
+    stub_api(lambda method, path, params, headers, body: stub.handle(method, path, body))
+
+    return stub
+
+
+def get_menu_items(img_links):
+    return [
+        {
+            'id': index,
+            'name': f'Пицца {index}',
+            'description': 'Тесто, сыр, томаты',
+            'product_image': {'url': img_link},
+        }
+        for index, img_link in enumerate(img_links, start=1)
+    ]
+
+
+def test_each_image_is_uploaded_once(stub_moltin, tmp_path):
+    img_links = ['https://example.com/margherita.jpg', 'https://example.com/pepperoni.jpg'] * 3
+    importer = ProductImporter(lambda: 'token', str(tmp_path / 'checkpoint'), workers=4)
+
+    stats = importer.run(get_menu_items(img_links))
+
+    assert sorted(stub_moltin.uploads) == sorted(set(img_links))
+    assert (stats['created'], stats['uploaded'], stats['reused']) == (6, 2, 4)
+
+
+def test_second_run_resumes_from_checkpoint(stub_moltin, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    menu_items = get_menu_items(['https://example.com/1.jpg', 'https://example.com/2.jpg', 'https://example.com/3.jpg'])
+    stub_moltin.failing_skus.add('2')
+
+    first_stats = ProductImporter(lambda: 'token', checkpoint_path, workers=2).run(menu_items)
+    stub_moltin.failing_skus.clear()
+    second_stats = ProductImporter(lambda: 'token', checkpoint_path, workers=2).run(menu_items)
+    third_stats = ProductImporter(lambda: 'token', checkpoint_path, workers=2).run(menu_items)
+
+    assert (first_stats['created'], first_stats['failed']) == (2, 1)
+    assert (second_stats['skipped'], second_stats['images_linked'], second_stats['created']) == (2, 1, 0)
+    assert (third_stats['skipped'], third_stats['uploaded']) == (3, 0)
+    assert len(stub_moltin.products) == 3
+    assert all(product['relationships'].get('main_image') for product in stub_moltin.products.values())
@@ -0,0 +1,49 @@
+import logging
+import time
+
+from inventory import StockTable
+
+
+def fail_fetch():
+    raise ConnectionError('moltin is down')
+
+
+def test_cold_table_does_not_refetch_before_retry_interval(caplog):
+    fetches = []
+
+    def fetch_stocks():
+        fetches.append(1)
+        fail_fetch()
+
+    stock_table = StockTable(fetch_stocks, retry_interval=3600)
+    with caplog.at_level(logging.WARNING, logger='shop_tg_bot'):
+        for _ in range(10):
+            assert stock_table.is_in_stock('margherita')
+
+    assert len(fetches) == 1
+    assert len(caplog.records) == 1
+
+
+def test_failed_background_refresh_keeps_stocks_until_retry_interval(caplog):
+    fetches = []
+
+    def fetch_stocks():
+        fetches.append(1)
+        if len(fetches) > 1:
+            fail_fetch()
+        return {'margherita': 0, 'pepperoni': 5}
+
+    stock_table = StockTable(fetch_stocks, ttl=0, retry_interval=3600)
+    stock_table.refresh()
+    time.sleep(0.01)
+
+    with caplog.at_level(logging.WARNING, logger='shop_tg_bot'):
+        for _ in range(10):
+            assert stock_table.get_sold_out_ids() == {'margherita'}
+            for _ in range(100):
+                if not stock_table._refreshing:
+                    break
+                time.sleep(0.01)
+
+    assert len(fetches) == 2
+    assert len(caplog.records) == 1
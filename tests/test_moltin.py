@@ -0,0 +1,145 @@
+import pytest
+import requests
+
+import moltin
+
+
+class StubResponse:
+
+    def __init__(self, json_data, status_code=200):
+        self.json_data = json_data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error', response=self)
+
+    def json(self):
+        return self.json_data
+
+
+class StubClient:
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, headers=None, params=None):
+        self.requests.append((url, params))
+        return self.respond(url, params)
+
+
+def get_cart(item_ids, included=None):
+    cart = {
+        'data': {
+            'meta': {'display_price': {'with_tax': {'amount': 100 * len(item_ids)}}},
+            'relationships': {'items': {'data': [{'type': 'cart_item', 'id': item_id} for item_id in item_ids]}},
+        },
+    }
+    if included is not None:
+        cart['included'] = {'items': included}
+
+    return cart
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    def use_stub_client(respond):
+        client = StubClient(respond)
+        monkeypatch.setattr(moltin, '_client', client)
+        monkeypatch.setattr(moltin, '_cart_include_disabled_until', 0)
+        return client
+
+    return use_stub_client
+
+
+def test_empty_cart_without_included_items_keeps_single_request_path(stub_client):
+    client = stub_client(lambda url, params: StubResponse(get_cart([]) if url.endswith('/42') else {'data': []}))
+
+    assert moltin.get_cart_items('token', 42) == ([], 0)
+    assert moltin._cart_include_disabled_until == 0
+    assert len(client.requests) == 1
+
+    client.respond = lambda url, params: StubResponse(get_cart(['item'], included=[{'id': 'item'}]))
+    assert moltin.get_cart_items('token', 42) == ([{'id': 'item'}], 100)
+    assert client.requests[-1][1] == {'include': 'items'}
+    assert len(client.requests) == 2
+
+
+def test_rejected_include_switches_to_two_requests(stub_client):
+    def respond(url, params):
+        if params:
+            return StubResponse({'errors': []}, status_code=400)
+        if url.endswith('/items'):
+            return StubResponse({'data': [{'id': 'item'}]})
+        return StubResponse(get_cart(['item']))
+
+    client = stub_client(respond)
+
+    assert moltin.get_cart_items('token', 42) == ([{'id': 'item'}], 100)
+    assert moltin.get_cart_items('token', 42) == ([{'id': 'item'}], 100)
+    assert [params for _, params in client.requests].count({'include': 'items'}) == 1
+
+
+def test_find_customer_sends_one_request(stub_client, monkeypatch):
+    submitted_requests = []
+    monkeypatch.setattr(moltin, 'get_page_prefetcher', lambda: submitted_requests)
+    client = stub_client(lambda url, params: StubResponse({'data': [{'id': 'customer'}]}))
+
+    assert moltin.find_customer('token', 'user@example.com') == {'id': 'customer'}
+    assert len(client.requests) == 1
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_without_links_stop_on_short_page(stub_client, prefetch):
+    entries = list(range(5))
+    client = stub_client(lambda url, params: StubResponse({
+        'data': entries[params['page[offset]']:params['page[offset]'] + params['page[limit]']],
+    }))
+
+    pages = list(moltin.iter_pages('https://api.moltin.com/v2/flows', {}, page_size=2, prefetch=prefetch))
+
+    assert pages == [[0, 1], [2, 3], [4]]
+    assert [params['page[offset]'] for _, params in client.requests] == [0, 2, 4]
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_without_links_stop_on_empty_page(stub_client, prefetch):
+    entries = list(range(4))
+    client = stub_client(lambda url, params: StubResponse({
+        'data': entries[params['page[offset]']:params['page[offset]'] + params['page[limit]']],
+    }))
+
+    pages = list(moltin.iter_pages('https://api.moltin.com/v2/flows', {}, page_size=2, prefetch=prefetch))
+
+    assert pages == [[0, 1], [2, 3], []]
+    assert len(client.requests) == 3
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_follow_next_link_until_it_is_null(stub_client, prefetch):
+    pages_by_url = {
+        'https://api.moltin.com/v2/customers': {'data': [1, 2], 'links': {'next': 'https://api.moltin.com/page-2'}},
+        'https://api.moltin.com/page-2': {'data': [3, 4], 'links': {'next': None}},
+    }
+    client = stub_client(lambda url, params: StubResponse(pages_by_url[url]))
+
+    pages = list(moltin.iter_pages('https://api.moltin.com/v2/customers', {}, page_size=2, prefetch=prefetch))
+
+    assert pages == [[1, 2], [3, 4]]
+    assert [url for url, _ in client.requests] == list(pages_by_url)
+    assert client.requests[1][1] is None
+
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_pages_stop_when_next_link_points_to_current_page(stub_client, prefetch):
+    page = {
+        'data': [1, 2],
+        'links': {'current': 'https://api.moltin.com/page-1', 'next': 'https://api.moltin.com/page-1'},
+    }
+    client = stub_client(lambda url, params: StubResponse(page))
+
+    pages = list(moltin.iter_pages('https://api.moltin.com/v2/customers', {}, page_size=2, prefetch=prefetch))
+
+    assert pages == [[1, 2]]
+    assert len(client.requests) == 1
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from geolocation_tools import PizzeriaIndex
+
+PIZZERIAS = [
+    {'id': '1', 'Address': 'Москва, Тверская, 1', 'Latitude': '55.757', 'Longitude': '37.614'},
+    {'id': '2', 'Address': 'Москва, Арбат, 10', 'Latitude': '55.751', 'Longitude': '37.596'},
+]
+
+
+def test_stale_index_is_served_when_refresh_fails():
+    fetches = []
+
+    def fetch_pizzerias(moltin_token):
+        fetches.append(moltin_token)
+        if len(fetches) > 1:
+            raise ConnectionError('moltin is down')
+        return PIZZERIAS
+
+    pizzeria_index = PizzeriaIndex(fetch_pizzerias, ttl=0)
+    pizzeria_index.refresh('token')
+    time.sleep(0.01)
+
+    nearest_pizzeria, = pizzeria_index.get_nearest('37.615', '55.756', 'token')
+    for _ in range(50):
+        if len(fetches) > 1:
+            break
+        time.sleep(0.01)
+
+    assert nearest_pizzeria['id'] == '1'
+    assert len(fetches) == 2
+    assert pizzeria_index.get_nearest('37.597', '55.751', 'token')[0]['id'] == '2'
+
+
+def test_expired_index_is_refreshed_by_a_single_caller():
+    fetch_started = threading.Event()
+    release_fetch = threading.Event()
+    fetches = []
+
+    def fetch_pizzerias(moltin_token):
+        fetches.append(moltin_token)
+        if len(fetches) > 1:
+            fetch_started.set()
+            release_fetch.wait(5)
+        return PIZZERIAS
+
+    pizzeria_index = PizzeriaIndex(fetch_pizzerias, ttl=0)
+    pizzeria_index.refresh('token')
+    time.sleep(0.01)
+
+    threads = [
+        threading.Thread(target=pizzeria_index.get_nearest, args=('37.615', '55.756', 'token'))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert fetch_started.wait(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(fetches) == 2
+    release_fetch.set()
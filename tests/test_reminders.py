@@ -0,0 +1,79 @@
+import time
+
+from reminders import ReminderScheduler
+
+
+def test_claimed_reminder_stays_inflight_while_another_worker_polls(redis_db):
+    sent_chat_ids = []
+    inflight_counts = []
+
+    def send_reminder(chat_id):
+        inflight_counts.append((redis_db.zcard(first_worker.pending_key), redis_db.zcard(first_worker.inflight_key)))
+        sent_chat_ids.append(chat_id)
+        second_worker.process_due()
+
+    first_worker = ReminderScheduler(redis_db, send_reminder)
+    second_worker = ReminderScheduler(redis_db, send_reminder)
+    first_worker.schedule(42, delay=-1)
+
+    first_worker.process_due()
+    second_worker.process_due()
+
+    assert sent_chat_ids == [42]
+    assert inflight_counts == [(0, 1)]
+    assert redis_db.zcard(first_worker.pending_key) == 0
+    assert redis_db.zcard(first_worker.inflight_key) == 0
+
+
+def test_crash_after_claim_leaves_reminder_to_be_requeued(redis_db):
+    sent_chat_ids = []
+
+    def crash(chat_id):
+        raise KeyboardInterrupt
+
+    crashed_worker = ReminderScheduler(redis_db, crash, visibility_timeout=0)
+    crashed_worker.schedule(42, delay=-1)
+    try:
+        crashed_worker.process_due()
+    except KeyboardInterrupt:
+        pass
+
+    worker = ReminderScheduler(redis_db, sent_chat_ids.append, retry_delay=0)
+    time.sleep(0.01)
+    worker.process_due()
+    worker.process_due()
+
+    assert sent_chat_ids == [42]
+    assert worker.get_stats()['requeued'] == 1
+
+
+def test_failing_reminder_is_dropped_after_max_attempts(redis_db):
+    def send_reminder(chat_id):
+        raise RuntimeError('bot was blocked by the user')
+
+    reminders = ReminderScheduler(redis_db, send_reminder, max_attempts=3, retry_delay=0)
+    reminders.schedule(42, delay=-1)
+
+    for _ in range(5):
+        reminders.process_due()
+
+    stats = reminders.get_stats()
+    assert stats['failed'] == 3
+    assert stats['dropped'] == 1
+    assert stats['pending'] == 0
+    assert stats['inflight'] == 0
+
+
+def test_expired_inflight_reminder_is_sent_again(redis_db):
+    sent_chat_ids = []
+    reminders = ReminderScheduler(redis_db, sent_chat_ids.append, retry_delay=0)
+    reminders.schedule(42, delay=-1)
+    reminder = redis_db.zrange(reminders.pending_key, 0, -1)[0]
+    redis_db.zrem(reminders.pending_key, reminder)
+    redis_db.zadd(reminders.inflight_key, {reminder: time.time() - 1})
+
+    reminders.process_due()
+    reminders.process_due()
+
+    assert sent_chat_ids == [42]
+    assert reminders.get_stats()['requeued'] == 1
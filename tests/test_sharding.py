@@ -0,0 +1,112 @@
+import threading
+import time
+
+import redis
+
+from sharding import ShardWorker, UpdateStreamPublisher
+
+
+def get_update(chat_id, text):
+    return {'update_id': 1, 'message': {'chat': {'id': chat_id}, 'text': text}}
+
+
+def test_second_worker_does_not_consume_an_owned_shard(redis_db):
+    first_worker = ShardWorker(redis_db, 0, lambda update_json: None)
+    second_worker = ShardWorker(redis_db, 0, lambda update_json: None)
+    second_worker.consumer = 'another-process-0'
+
+    assert first_worker._acquire_shard()
+    assert not second_worker._acquire_shard()
+
+    first_worker._release_shard()
+    assert second_worker._acquire_shard()
+
+
+def test_worker_keeps_reading_after_redis_connection_error(redis_db, monkeypatch):
+    processed_texts = []
+    worker = ShardWorker(redis_db, 0, lambda update_json: processed_texts.append(update_json['message']['text']),
+                         block_ms=10)
+    UpdateStreamPublisher(redis_db, shards=1).publish(get_update(42, 'привет'))
+
+    xreadgroup = redis_db.xreadgroup
+    calls = []
+
+    def flaky_xreadgroup(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise redis.ConnectionError('Connection reset by peer')
+        if processed_texts:
+            worker.stop()
+        return xreadgroup(*args, **kwargs)
+
+    monkeypatch.setattr(redis_db, 'xreadgroup', flaky_xreadgroup)
+    monkeypatch.setattr(worker._stopped, 'wait', lambda timeout: worker._stopped.is_set())
+
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert processed_texts == ['привет']
+    assert worker.stats['redis_errors'] == 1
+
+
+def test_new_owner_processes_abandoned_messages_before_new_ones(redis_db):
+    publisher = UpdateStreamPublisher(redis_db, shards=1)
+    dead_worker = ShardWorker(redis_db, 0, lambda update_json: None)
+    dead_worker.consumer = 'dead-process-0'
+    publisher.publish(get_update(42, 'первое'))
+    publisher.publish(get_update(42, 'второе'))
+    redis_db.xgroup_create(dead_worker.stream, dead_worker.group, id='0')
+    redis_db.xreadgroup(dead_worker.group, dead_worker.consumer, {dead_worker.stream: '>'})
+    publisher.publish(get_update(42, 'третье'))
+
+    processed_texts = []
+
+    def process_update(update_json):
+        processed_texts.append(update_json['message']['text'])
+        if len(processed_texts) == 3:
+            worker.stop()
+
+    worker = ShardWorker(redis_db, 0, process_update, block_ms=10)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert processed_texts == ['первое', 'второе', 'третье']
+    assert worker.stats['reclaimed'] == 2
+
+
+def test_lease_is_renewed_while_a_slow_update_is_processed(redis_db):
+    handler_started = threading.Event()
+
+    def process_update(update_json):
+        handler_started.set()
+        time.sleep(1.5)
+        worker.stop()
+
+    worker = ShardWorker(redis_db, 0, process_update, block_ms=10, lease_ttl=1)
+    other_worker = ShardWorker(redis_db, 0, lambda update_json: None)
+    other_worker.consumer = 'another-process-0'
+    UpdateStreamPublisher(redis_db, shards=1).publish(get_update(42, 'привет'))
+
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    assert handler_started.wait(5)
+    time.sleep(1.2)
+
+    assert not other_worker._acquire_shard()
+    thread.join(timeout=5)
+    assert worker.stats['processed'] == 1
+    assert other_worker._acquire_shard()
+
+
+def test_lease_of_another_owner_is_not_extended(redis_db):
+    worker = ShardWorker(redis_db, 0, lambda update_json: None)
+    redis_db.set(worker.owner_key, 'another-process-0', ex=5)
+
+    assert not worker._acquire_shard()
+    worker._release_shard()
+    assert redis_db.get(worker.owner_key) == b'another-process-0'
+    assert redis_db.ttl(worker.owner_key) <= 5
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+import moltin
+from moltin import MoltinClient, TokenManager, get_token_manager
+
+
+class StubResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class StubSession:
+
+    def __init__(self, valid_tokens):
+        self.valid_tokens = valid_tokens
+        self.tokens = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        token = headers['Authorization'][len('Bearer '):]
+        self.tokens.append(token)
+        return StubResponse(200 if token in self.valid_tokens else 401)
+
+
+def stub_token_requests(token_manager):
+    issued_tokens = []
+
+    def request_token():
+        issued_tokens.append(f'token-{len(issued_tokens) + 1}')
+        return issued_tokens[-1], time.time() + 3600
+
+    token_manager._request_token = request_token
+    return issued_tokens
+
+
+@pytest.fixture
+def token_manager(monkeypatch):
+    monkeypatch.setattr(moltin, '_token_managers', {})
+    token_manager = get_token_manager('client-key', 'secret-key')
+    yield token_manager
+    token_manager._timer.cancel()
+
+
+def test_processes_share_a_single_token_refresh(redis_db):
+    token_managers = [TokenManager('client-key', 'secret-key', redis_db=redis_db) for _ in range(5)]
+    issued_tokens = []
+
+    def request_token():
+        time.sleep(0.3)
+        issued_tokens.append('token-1')
+        return 'token-1', time.time() + 3600
+
+    for token_manager in token_managers:
+        token_manager._request_token = request_token
+
+    tokens = []
+    threads = [
+        threading.Thread(target=lambda token_manager=token_manager: tokens.append(token_manager.get_token()))
+        for token_manager in token_managers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    for token_manager in token_managers:
+        token_manager._timer.cancel()
+
+    assert tokens == ['token-1'] * 5
+    assert len(issued_tokens) == 1
+    assert not redis_db.exists(token_managers[0].lock_key)
+
+
+def test_lock_taken_over_by_another_process_is_not_released(redis_db):
+    token_manager = TokenManager('client-key', 'secret-key', redis_db=redis_db)
+
+    def request_token():
+        redis_db.set(token_manager.lock_key, 'another-process')
+        return 'token-1', time.time() + 3600
+
+    token_manager._request_token = request_token
+
+    assert token_manager.get_token() == 'token-1'
+    assert redis_db.get(token_manager.lock_key) == b'another-process'
+    token_manager._timer.cancel()
+
+
+def test_rejected_token_is_refreshed_and_request_retried(token_manager):
+    issued_tokens = stub_token_requests(token_manager)
+    client = MoltinClient()
+    client.session = StubSession(valid_tokens={'token-2'})
+
+    headers = {'Authorization': f'Bearer {token_manager.get_token()}'}
+    response = client.get(f'{moltin.API_URL}/v2/carts/1', headers=headers)
+
+    assert response.status_code == 200
+    assert client.session.tokens == ['token-1', 'token-2']
+    assert issued_tokens == ['token-1', 'token-2']
+
+
+def test_request_with_previous_token_is_retried_without_another_refresh(token_manager):
+    issued_tokens = stub_token_requests(token_manager)
+    stale_token = token_manager.get_token()
+    token_manager.invalidate(stale_token)
+    fresh_token = token_manager.get_token()
+    client = MoltinClient()
+    client.session = StubSession(valid_tokens={fresh_token})
+
+    response = client.get(f'{moltin.API_URL}/v2/carts/1', headers={'Authorization': f'Bearer {stale_token}'})
+
+    assert response.status_code == 200
+    assert client.session.tokens == ['token-1', 'token-2']
+    assert issued_tokens == ['token-1', 'token-2']
@@ -0,0 +1,47 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from webhook_server import SECRET_TOKEN_HEADER, WebhookServer
+
+
+@pytest.fixture
+def webhook():
+    accepted_updates = []
+
+    def accept_update(update_json):
+        accepted_updates.append(update_json)
+        return True
+
+    server = WebhookServer(accept_update, lambda: {}, 'secret', host='127.0.0.1', port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.httpd.server_address
+    yield f'http://{host}:{port}/webhook', accepted_updates
+    server.shutdown()
+
+
+def test_update_with_secret_token_is_accepted(webhook):
+    url, accepted_updates = webhook
+    update = {'update_id': 1, 'message': {'chat': {'id': 42}, 'text': '/start'}}
+
+    response = requests.post(url, data=json.dumps(update), headers={SECRET_TOKEN_HEADER: 'secret'}, timeout=5)
+
+    assert response.status_code == 200
+    assert accepted_updates == [update]
+
+
+@pytest.mark.parametrize('headers', [{}, {SECRET_TOKEN_HEADER: 'guess'}])
+def test_update_without_secret_token_is_rejected(webhook, headers):
+    url, accepted_updates = webhook
+
+    response = requests.post(url, data=json.dumps({'update_id': 1}), headers=headers, timeout=5)
+
+    assert response.status_code == 403
+    assert accepted_updates == []
+
+
+def test_server_requires_secret_token():
+    with pytest.raises(ValueError):
+        WebhookServer(lambda update_json: True, lambda: {}, None, port=0)
@@ -0,0 +1,148 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('shop_tg_bot')
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class ChatSerialExecutor:
+
+    def __init__(self, process_update, workers=8, backlog=1000):
+        self.process_update = process_update
+        self.lanes = [queue.Queue(maxsize=max(backlog // workers, 1)) for _ in range(workers)]
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, args=(lane,), daemon=True) for lane in self.lanes
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, chat_id, update_json):
+        lane = self.lanes[hash(chat_id) % len(self.lanes)]
+        try:
+            lane.put_nowait(update_json)
+        except queue.Full:
+            self._count('rejected')
+            return False
+
+        self._count('accepted')
+        return True
+
+    def stop(self):
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['backlog'] = [lane.qsize() for lane in self.lanes]
+        stats['backlog_limit'] = sum(lane.maxsize for lane in self.lanes)
+
+        return stats
+
+    def _count(self, counter):
+        with self._lock:
+            self.stats[counter] += 1
+
+    def _work(self, lane):
+        while True:
+            update_json = lane.get()
+            if update_json is None:
+                return
+            try:
+                self.process_update(update_json)
+                self._count('processed')
+            except Exception:
+                self._count('failed')
+                logger.exception('Не удалось обработать обновление из вебхука')
+
+
+class WebhookServer:
+
+    def __init__(self, accept_update, get_stats, secret_token, host='0.0.0.0', port=8443, path='/webhook'):
+        if not secret_token:
+            raise ValueError('Вебхук нельзя запустить без секретного токена')
+        self.accept_update = accept_update
+        self.get_stats = get_stats
+        self.secret_token = secret_token
+        self.path = path
+        self.httpd = ThreadingHTTPServer((host, port), self._build_request_handler())
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _build_request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                secret_token = self.headers.get(SECRET_TOKEN_HEADER, '')
+                if not hmac.compare_digest(secret_token.encode('utf-8'), server.secret_token.encode('utf-8')):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                content_length = int(self.headers.get('Content-Length', 0))
+                try:
+                    update_json = json.loads(self.rfile.read(content_length))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                self.send_response(200 if server.accept_update(update_json) else 503)
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = json.dumps(server.get_stats()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return WebhookRequestHandler
+
+
+def get_update_chat_id(update_json):
+    for update_type in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if update_type in update_json:
+            return update_json[update_type]['chat']['id']
+
+    callback_query = update_json.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+
+    for update_type in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        if update_type in update_json:
+            return update_json[update_type]['from']['id']
+
+    return update_json.get('update_id')